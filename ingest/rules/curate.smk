@@ -2,7 +2,7 @@
 This part of the workflow handles curating the data into standardized
 formats and expects input file
 
-    sequences_ndjson = "data/ppx_flat.ndjson"
+    ppx_ndjson = "results/ppx.ndjson.zst"
 
 This will produce output files as
 
@@ -23,11 +23,18 @@ def format_field_map(field_map: dict[str, str]) -> list[str]:
 
 
 rule generate_continent:
+    """
+    Flatten the Pathoplexus records to the metadata of the latest versions plus
+    the sequence, drop unused metadata fields and add the continent in a single pass.
+    """
     input:
-        ndjson="results/ppx_flat.ndjson.zst",
+        ndjson="results/ppx.ndjson.zst",
         script="scripts/generate_continent.py",
     output:
         ndjson="results/ppx_flat_continent.ndjson.zst",
+    params:
+        drop_fields=config["flatten"]["drop_fields"],
+    threads: workflow.cores
     benchmark:
         "benchmarks/generate_continent.txt"
     log:
@@ -38,11 +45,20 @@ rule generate_continent:
 
         python {input.script:q} \
             --input {input.ndjson:q} \
-            --output {output.ndjson:q}
+            --output {output.ndjson:q} \
+            --flatten \
+            --drop-fields {params.drop_fields:q} \
+            --jobs {threads:q}
         """
 
 
 rule curate:
+    """
+    Run the augur curate steps and scripts/curate-urls.py as one in-process chain
+    over a single parse of the records, with the same output as piping the records
+    through each command in turn. Curated records are cached by record version, so
+    that only new or changed records are curated again.
+    """
     input:
         sequences_ndjson="results/ppx_flat_continent.ndjson.zst",
         geolocation_rules=resolve_config_path(
@@ -50,10 +66,12 @@ rule curate:
         ),
         annotations=resolve_config_path(config["curate"]["annotations"]),
         urls_script="scripts/curate-urls.py",
+        curate_script="scripts/curate-chain.py",
     output:
         metadata="data/all_metadata.tsv",
         sequences="results/sequences.fasta",
         # ndjson="results/curated.ndjson.zst",
+    threads: workflow.cores
     benchmark:
         "benchmarks/curate.txt"
     log:
@@ -73,38 +91,44 @@ rule curate:
         annotations_id=config["curate"]["annotations_id"],
         id_field=config["curate"]["id_field"],
         sequence_field=config["curate"]["sequence_field"],
+        cache="results/curate_cache.sqlite",
+        cache_key_field=config["curate"]["cache_key_field"],
     shell:
         r"""
         exec &> >(tee {log:q})
 
         zstdcat {input.sequences_ndjson:q} \
-            | augur curate rename \
-                --field-map {params.field_map:q} \
-            | augur curate normalize-strings \
-            | augur curate transform-strain-name \
-                --strain-regex {params.strain_regex:q} \
-                --backup-fields {params.strain_backup_fields:q} \
-            | augur curate format-dates \
-                --date-fields {params.date_fields:q} \
-                --expected-date-formats {params.expected_date_formats:q} \
-            | augur curate titlecase \
-                --titlecase-fields {params.titlecase_fields:q} \
-                --articles {params.articles:q} \
-                --abbreviations {params.abbreviations:q} \
-            | augur curate abbreviate-authors \
-                --authors-field {params.authors_field:q} \
-                --default-value {params.authors_default_value:q} \
-                --abbr-authors-field {params.abbr_authors_field:q} \
-            | augur curate apply-geolocation-rules \
-                --geolocation-rules {input.geolocation_rules:q} \
-            | python {input.urls_script:q} \
-            | augur curate apply-record-annotations \
-                --annotations {input.annotations:q} \
-                --id-field {params.annotations_id:q} \
-                --output-metadata {output.metadata:q} \
-                --output-fasta {output.sequences:q} \
-                --output-id-field {params.id_field:q} \
-                --output-seq-field {params.sequence_field:q}
+            | python {input.curate_script:q} \
+                --jobs {threads:q} \
+                --cache {params.cache:q} \
+                --cache-key-field {params.cache_key_field:q} \
+                rename \
+                    --field-map {params.field_map:q} \
+                :: normalize-strings \
+                :: transform-strain-name \
+                    --strain-regex {params.strain_regex:q} \
+                    --backup-fields {params.strain_backup_fields:q} \
+                :: format-dates \
+                    --date-fields {params.date_fields:q} \
+                    --expected-date-formats {params.expected_date_formats:q} \
+                :: titlecase \
+                    --titlecase-fields {params.titlecase_fields:q} \
+                    --articles {params.articles:q} \
+                    --abbreviations {params.abbreviations:q} \
+                :: abbreviate-authors \
+                    --authors-field {params.authors_field:q} \
+                    --default-value {params.authors_default_value:q} \
+                    --abbr-authors-field {params.abbr_authors_field:q} \
+                :: apply-geolocation-rules \
+                    --geolocation-rules {input.geolocation_rules:q} \
+                :: {input.urls_script:q} \
+                :: apply-record-annotations \
+                    --annotations {input.annotations:q} \
+                    --id-field {params.annotations_id:q} \
+                    --output-metadata {output.metadata:q} \
+                    --output-fasta {output.sequences:q} \
+                    --output-id-field {params.id_field:q} \
+                    --output-seq-field {params.sequence_field:q}
         """
 
 
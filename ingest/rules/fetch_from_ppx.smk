@@ -8,101 +8,48 @@ REQUIRED INPUTS:
 OUTPUTS:
 
     ndjson = results/ppx.ndjson.zst
-    flat_ndjson = results/ppx_flat.ndjson.zst
+    manifest = results/ppx.manifest.json
 
 """
 
 
 rule fetch_ppx_data:
+    """
+    Download the released data, counting and hashing the records while they are
+    written to disk, and write a manifest with the record count, sha256 and headers.
+
+    If fetch.ppx_snapshot is set, records are also kept in a local snapshot store
+    that must persist between runs to be of use. The download is conditional
+    on the ETag of the last snapshot. When the released data has not changed,
+    the output is restored byte for byte from the copy of the last download in
+    the snapshot, so its sha256 and any uploads keyed on it do not change.
+    """
+    input:
+        script="scripts/fetch-ppx.py",
     output:
         ppx_ndjson="results/ppx.ndjson.zst",
         ppx_headers="results/ppx.headers.txt",
+        ppx_manifest="results/ppx.manifest.json",
     benchmark:
         "benchmarks/fetch_ppx_data.txt"
     params:
         ppx_api_url="https://backend.pathoplexus.org/mpox/get-released-data?compression=zstd",
+        # Kept between runs, see fetch.ppx_snapshot in the config
+        snapshot=(
+            ("--snapshot " + config["fetch"]["ppx_snapshot"])
+            if config.get("fetch", {}).get("ppx_snapshot")
+            else ""
+        ),
     log:
         "logs/fetch_ppx_data.txt",
     shell:
         r"""
         exec &> >(tee {log:q})
 
-
-        echo "Downloading: {params.ppx_api_url:q}"
-        curl {params.ppx_api_url:q} -fS -D {output.ppx_headers:q} -o {output.ppx_ndjson:q}
-
-        expected="$(grep -i '^x-total-records:' {output.ppx_headers:q} | awk '{{print $2}}' | tr -d '[:space:]' || true)"
-
-        echo "Counting records..."
-        actual="$(zstd -d -c {output.ppx_ndjson:q} | jq -n 'reduce inputs as $item (0; . + 1)')"
-
-        echo "Actual records:   $actual"
-        echo "Expected records: $expected"
-        if [[ "$actual" -ne "$expected" ]]; then
-            echo "Mismatch: expected $expected, got $actual" >&2
-            exit 2
-        fi
-
-        echo "OK: record counts match."
-        """
-
-
-rule flatten_ppx_data:
-    input:
-        ppx_ndjson="results/ppx.ndjson.zst",
-    output:
-        ppx_flat="results/ppx_flat.ndjson.zst",
-    benchmark:
-        "benchmarks/flatten_ppx_data.txt"
-    log:
-        "logs/flatten_ppx_data.txt",
-    shell:
-        r"""
-        exec &> >(tee {log:q})
-
-        echo "Flattening Pathoplexus data and removing all-null fields..."
-        zstdcat {input.ppx_ndjson:q} | jq -c '
-          select(.metadata.versionStatus == "LATEST_VERSION")
-          | (.metadata
-              | del(
-                .bodyProduct,
-                .comment,
-                .diagnosticMeasurementMethod,
-                .diagnosticMeasurementUnit,
-                .diagnosticMeasurementValue,
-                .diagnosticTargetGeneName,
-                .diagnosticTargetPresence,
-                .environmentalMaterial,
-                .experimentalSpecimenRoleType,
-                .exposureDetails,
-                .exposureEvent,
-                .exposureSetting,
-                .foodProduct,
-                .foodProductProperties,
-                .geoLocLatitude,
-                .geoLocLongitude,
-                .gisaidIsolateId,
-                .hostAgeBin,
-                .hostHealthOutcome,
-                .hostRole,
-                .hostVaccinationStatus,
-                .ncbiSubmitterCountry,
-                .passageMethod,
-                .presamplingActivity,
-                .purposeOfSampling,
-                .qualityControlDetails,
-                .qualityControlDetermination,
-                .qualityControlIssues,
-                .qualityControlMethodName,
-                .qualityControlMethodVersion,
-                .rawSequenceDataProcessingMethod,
-                .signsAndSymptoms,
-                .specimenProcessing,
-                .specimenProcessingDetails,
-                .travelHistory,
-                .versionComment
-              )
-            )
-          + {{sequence: .unalignedNucleotideSequences.main}}
-        ' | zstd -c > {output.ppx_flat:q}
+        python {input.script:q} \
+            --url {params.ppx_api_url:q} \
+            --output {output.ppx_ndjson:q} \
+            --headers {output.ppx_headers:q} \
+            --manifest {output.ppx_manifest:q} \
+            {params.snapshot}
         """
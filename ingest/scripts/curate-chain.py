@@ -0,0 +1,580 @@
+"""
+Run a chain of `augur curate` subcommands and custom curate scripts in a single
+process, with the same output as piping NDJSON records through them one by one.
+
+Steps are separated by `::`. Each step is either an `augur curate` subcommand
+with its usual arguments or the path to a custom curate script that defines
+`run(args, records)`, such as scripts/curate-urls.py:
+
+    zstdcat records.ndjson.zst | python scripts/curate-chain.py \\
+        rename --field-map a=b \\
+        :: normalize-strings \\
+        :: scripts/curate-urls.py \\
+        :: apply-record-annotations --annotations annotations.tsv \\
+            --output-metadata metadata.tsv
+
+Records are read as NDJSON from stdin and parsed once. The output options of
+the last step apply to the whole chain, as if it were the last command of the
+pipe. With --jobs > 1, batches of records are curated in worker processes that
+each run one instance of the chain, and the output is written in input order.
+Record numbers in warnings and errors then count the records of each worker.
+
+With --cache, curated records are kept in a SQLite cache keyed by a field that
+identifies the version of an input record (--cache-key-field). Records whose
+input line and annotations are unchanged are taken from the cache instead of
+being curated again; the cache is refreshed at the end of every successful run.
+It is discarded as a whole when the steps, their arguments, the geolocation
+rules, the custom scripts or the augur version change. Warnings of the steps
+are only printed for records that are curated in the run.
+"""
+import argparse
+import csv
+import hashlib
+import importlib.util
+import multiprocessing
+import os
+import queue
+import sqlite3
+import sys
+import tempfile
+from collections import Counter, defaultdict, deque
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from augur.__version__ import __version__ as augur_version
+from augur.argparse_ import add_command_subparsers
+from augur.curate import SUBCOMMAND_ATTRIBUTE, SUBCOMMANDS, create_shared_parser, validate_records
+from augur.errors import AugurError
+from augur.io.json import as_json, dump_ndjson, load_json
+from augur.io.metadata import write_records_to_tsv
+from augur.io.print import print_err
+from augur.io.sequences import write_records_to_fasta
+
+
+STEP_SEPARATOR = "::"
+
+# Approximate number of characters of NDJSON sent to a worker at a time
+BATCH_SIZE = 8 * 1024 * 1024
+
+CACHE_VERSION = 1
+OUTPUT_PATH_OPTIONS = {"--output-metadata", "--output-fasta"}
+
+
+def split_steps(argv: list[str]) -> list[list[str]]:
+    steps = [[]]
+    for arg in argv:
+        if arg == STEP_SEPARATOR:
+            steps.append([])
+        else:
+            steps[-1].append(arg)
+    if any(not step for step in steps):
+        raise AugurError(f"Empty curate step in {' '.join(argv)!r}.")
+    return steps
+
+
+def load_custom_step(path: str):
+    spec = importlib.util.spec_from_file_location(Path(path).stem.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if not hasattr(module, "run"):
+        raise AugurError(f"Custom curate script {path!r} does not define run(args, records).")
+    return module
+
+
+def parse_steps(step_argvs: list[list[str]]) -> list[tuple[str, argparse.Namespace, object]]:
+    """
+    Parse the arguments of each step with the `augur curate` subcommand parsers.
+
+    Returns (name, args, command) for each step, where command has a run(args, records) function.
+    """
+    parser = argparse.ArgumentParser(prog="augur curate")
+    subparsers = parser.add_subparsers(dest="subcommand")
+    subparsers.shared_parser = create_shared_parser()
+    add_command_subparsers(subparsers, SUBCOMMANDS, SUBCOMMAND_ATTRIBUTE)
+
+    steps = []
+    for index, step_argv in enumerate(step_argvs):
+        name, *step_args = step_argv
+        if name.endswith(".py"):
+            if step_args:
+                raise AugurError(f"Custom curate script {name!r} does not take arguments.")
+            steps.append((name, argparse.Namespace(), load_custom_step(name)))
+            continue
+
+        args = parser.parse_args(step_argv)
+        if args.metadata or args.fasta:
+            raise AugurError(f"Curate step {name!r}: records can only be read as NDJSON from stdin.")
+        if index < len(step_argvs) - 1 and (args.output_metadata or args.output_fasta):
+            raise AugurError(f"Curate step {name!r}: only the last step can write output files.")
+        steps.append((name, args, getattr(args, SUBCOMMAND_ATTRIBUTE)))
+    return steps
+
+
+def run_step(name: str, args: argparse.Namespace, command, records: Iterable[dict]) -> Iterator[dict]:
+    """
+    Run a step, checking that it yields one record for each input record before
+    it reads the next one, which CurateChain relies on to match records to batches.
+    """
+    consumed = 0
+    produced = 0
+
+    def inputs():
+        nonlocal consumed
+        records_iter = iter(records)
+        while True:
+            # Check before pulling, as there may not be another record in the batch
+            if consumed > produced:
+                raise AugurError(
+                    f"Curate step {name!r} read record {consumed + 1} before yielding record {consumed}. "
+                    "Only steps that yield one record per input record can be chained."
+                )
+            try:
+                record = next(records_iter)
+            except StopIteration:
+                return
+            consumed += 1
+            yield record
+
+    for record in command.run(args, inputs()):
+        produced += 1
+        if produced > consumed:
+            raise AugurError(
+                f"Curate step {name!r} yielded record {produced} after reading {consumed} records. "
+                "Only steps that yield one record per input record can be chained."
+            )
+        yield record
+
+    if produced != consumed:
+        raise AugurError(
+            f"Curate step {name!r} yielded {produced} records for {consumed} input records. "
+            "Only steps that yield one record per input record can be chained."
+        )
+
+
+def run_steps(steps, records: Iterable[dict]) -> Iterator[dict]:
+    """
+    Chain the steps as generators, validating the fields of the records between
+    steps as `augur curate` does for each command.
+    """
+    for name, args, command in steps:
+        records = validate_records(records, name, True)
+        records = run_step(name, args, command, records)
+        records = validate_records(records, name, False)
+    return records
+
+
+def output_args(steps) -> argparse.Namespace:
+    """Output options of the chain, which are those of the last step."""
+    _, args, _ = steps[-1]
+    for option in ("output_metadata", "output_fasta", "output_id_field", "output_seq_field"):
+        if not hasattr(args, option):
+            setattr(args, option, None)
+
+    if not args.output_fasta and (args.output_id_field or args.output_seq_field):
+        raise AugurError("The --output-id-field and --output-seq-field options should only be used when requesting a FASTA output.")
+
+    if args.output_fasta and (not args.output_id_field or not args.output_seq_field):
+        raise AugurError("The --output-id-field and --output-seq-field options are required for a FASTA output.")
+
+    return args
+
+
+def write_outputs(records: Iterator[dict], args: argparse.Namespace):
+    """Write records the way `augur curate` writes the output of a command."""
+    # First output FASTA, since the write fasta function yields the records again
+    # and removes the sequences from the records
+    if args.output_fasta:
+        records = write_records_to_fasta(
+            records,
+            args.output_fasta,
+            args.output_id_field,
+            args.output_seq_field)
+
+    if args.output_metadata:
+        write_records_to_tsv(records, args.output_metadata)
+
+    if not (args.output_fasta or args.output_metadata):
+        dump_ndjson(records)
+    else:
+        # Exhaust generator to ensure we run through all records
+        deque(records, maxlen=0)
+
+
+def iter_batches(lines: Iterable[str], batch_size: int = BATCH_SIZE) -> Iterator[list[str]]:
+    """Group non-empty NDJSON lines into batches of about batch_size characters."""
+    batch = []
+    size = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        batch.append(line)
+        size += len(line)
+        if size >= batch_size:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+
+class CurateChain:
+    """
+    One long-running instance of the chain of steps that is fed records in batches.
+
+    Every curate step yields exactly one record per input record (checked by
+    run_step), so pulling as many records from the chain as were fed consumes
+    exactly one batch.
+    """
+
+    def __init__(self, steps):
+        self.queue = deque()
+        self.records = run_steps(steps, self.feed())
+
+    def feed(self):
+        while True:
+            record = self.queue.popleft()
+            if record is None:
+                return
+            yield record
+
+    def curate(self, records: list[dict]) -> list[dict]:
+        self.queue.extend(records)
+        return [next(self.records) for _ in records]
+
+    def finish(self):
+        """End the chain so that steps can report on all of their records."""
+        self.queue.append(None)
+        deque(self.records, maxlen=0)
+
+
+def chain_fingerprint(step_argvs: list[list[str]], steps) -> str:
+    """
+    Fingerprint of everything the curated records depend on, apart from the
+    records themselves and the annotations, which are checked per record.
+    """
+    fingerprint = hashlib.sha256()
+    fingerprint.update(f"{CACHE_VERSION}\0{augur_version}\0".encode())
+    fingerprint.update(Path(__file__).read_bytes())
+    for step_argv, (name, args, _) in zip(step_argvs, steps):
+        # Output paths do not change the curated records
+        step_argv = [
+            arg for previous, arg in zip([None] + step_argv, step_argv)
+            if arg not in OUTPUT_PATH_OPTIONS and previous not in OUTPUT_PATH_OPTIONS
+        ]
+        fingerprint.update("\0".join(step_argv).encode() + b"\0\0")
+        if name.endswith(".py"):
+            fingerprint.update(Path(name).read_bytes())
+        if getattr(args, "geolocation_rules", None):
+            fingerprint.update(Path(args.geolocation_rules).read_bytes())
+    return fingerprint.hexdigest()
+
+
+def annotation_hashes(steps) -> tuple[str | None, dict[str, str]]:
+    """
+    Hash the annotation lines of each record ID of the apply-record-annotations step,
+    so that a change of the annotations file only invalidates the records it affects.
+
+    Returns the ID field of the annotations and the hashes by record ID.
+    """
+    for name, args, _ in steps:
+        if name == "apply-record-annotations":
+            lines = defaultdict(list)
+            with open(args.annotations, 'r', newline='') as annotations_fh:
+                for row in csv.reader(annotations_fh, delimiter='\t'):
+                    if row:
+                        lines[row[0]].append("\t".join(row))
+            return args.id_field, {
+                id: hashlib.sha256("\n".join(rows).encode()).hexdigest()
+                for id, rows in lines.items()
+            }
+    return None, {}
+
+
+class CurationCache:
+    """
+    Curated records of a previous run, keyed by a field that identifies the
+    version of an input record.
+
+    A cached record is reused when the NDJSON line of the input record and the
+    annotations of the record are unchanged. The sequence is not stored when the
+    curated record has the same sequence as the input record.
+    """
+
+    def __init__(self, path: str | None, key_field: str, seq_field: str | None, steps):
+        self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True) if path else None
+        self.key_field = key_field
+        self.seq_field = seq_field
+        self.id_field, self.annotations = annotation_hashes(steps)
+
+    def annotations_hash(self, record: dict) -> str:
+        if self.id_field is None:
+            return ""
+        return self.annotations.get(str(record.get(self.id_field)), "")
+
+    def lookup(self, record: dict, input_hash: str) -> tuple[dict, tuple] | None:
+        """Cached curated record and its cache entry, or None if it must be curated."""
+        key = record.get(self.key_field)
+        if self.connection is None or key is None:
+            return None
+        row = self.connection.execute(
+            "SELECT input_hash, annotations_hash, sequence_from_input, record FROM records WHERE key = ?",
+            (str(key),)
+        ).fetchone()
+        if row is None or row[0] != input_hash:
+            return None
+
+        curated = load_json(row[3])
+        if row[1] != self.annotations_hash(curated):
+            return None
+        if row[2]:
+            curated[self.seq_field] = record.get(self.seq_field)
+        return curated, (str(key), *row)
+
+    def entry(self, record: dict, input_hash: str, curated: dict) -> tuple | None:
+        """Cache entry for a newly curated record."""
+        key = record.get(self.key_field)
+        if key is None:
+            return None
+        sequence_from_input = (
+            self.seq_field is not None
+            and self.seq_field in curated
+            and curated[self.seq_field] == record.get(self.seq_field)
+        )
+        stored = curated
+        if sequence_from_input:
+            stored = {**curated, self.seq_field: None}
+        return str(key), input_hash, self.annotations_hash(curated), sequence_from_input, as_json(stored)
+
+
+class CacheWriter:
+    """Write the cache entries of this run to a new cache that replaces the old one on success."""
+
+    def __init__(self, path: str, fingerprint: str):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, self.tmp_path = tempfile.mkstemp(dir=directory, suffix=".sqlite")
+        os.close(fd)
+        self.connection = sqlite3.connect(self.tmp_path)
+        self.connection.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID")
+        self.connection.execute(
+            "CREATE TABLE records (key TEXT PRIMARY KEY, input_hash TEXT, annotations_hash TEXT, "
+            "sequence_from_input INTEGER, record TEXT)"
+        )
+        self.connection.execute("INSERT INTO info VALUES ('fingerprint', ?)", (fingerprint,))
+
+    def add(self, entry: tuple):
+        self.connection.execute("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)", entry)
+
+    def commit(self):
+        self.connection.commit()
+        self.connection.close()
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self):
+        self.connection.close()
+        os.remove(self.tmp_path)
+
+
+def cache_fingerprint(path: str) -> str | None:
+    if not os.path.exists(path):
+        return None
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        row = connection.execute("SELECT value FROM info WHERE key = 'fingerprint'").fetchone()
+    except sqlite3.DatabaseError:
+        return None
+    finally:
+        connection.close()
+    return row[0] if row else None
+
+
+def curate_batch(lines: list[str], chain: CurateChain, cache: CurationCache | None) -> list[tuple]:
+    """
+    Curate a batch of NDJSON lines, reusing cached records where possible.
+
+    Returns (curated record, cache entry or None, whether it came from the cache)
+    for each line, in order.
+    """
+    results = [None] * len(lines)
+    misses = []
+    for position, line in enumerate(lines):
+        record = load_json(line)
+        input_hash = None
+        if cache is not None:
+            input_hash = hashlib.sha256(line.rstrip("\n").encode()).hexdigest()
+            cached = cache.lookup(record, input_hash)
+            if cached is not None:
+                results[position] = (*cached, True)
+                continue
+        misses.append((position, record, input_hash, record.copy()))
+
+    curated_records = chain.curate([record for _, record, _, _ in misses])
+    for (position, _, input_hash, original), curated in zip(misses, curated_records):
+        entry = cache.entry(original, input_hash, curated) if cache is not None else None
+        results[position] = (curated, entry, False)
+    return results
+
+
+def worker(step_argvs, cache_args, tasks, results):
+    """Curate batches of NDJSON lines with one long-running instance of the chain."""
+    try:
+        steps = parse_steps(step_argvs)
+        chain = CurateChain(steps)
+        cache = CurationCache(*cache_args, steps) if cache_args else None
+        for index, batch in iter(tasks.get, None):
+            results.put(("records", index, curate_batch(batch, chain, cache)))
+        chain.finish()
+        results.put(("done", None, None))
+    except (AugurError, OSError) as e:
+        results.put(("error", None, str(e)))
+
+
+def run_serial(step_argvs, cache_args, lines: Iterable[str]) -> Iterator[tuple]:
+    """Curate NDJSON lines in batches in this process."""
+    steps = parse_steps(step_argvs)
+    chain = CurateChain(steps)
+    cache = CurationCache(*cache_args, steps) if cache_args else None
+    for batch in iter_batches(lines):
+        yield from curate_batch(batch, chain, cache)
+    chain.finish()
+
+
+def run_parallel(step_argvs, cache_args, lines: Iterable[str], jobs: int) -> Iterator[tuple]:
+    """
+    Curate NDJSON lines in batches in worker processes and yield the results
+    in input order.
+    """
+    tasks = multiprocessing.Queue(maxsize=jobs)
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=worker, args=(step_argvs, cache_args, tasks, results), daemon=True)
+        for _ in range(jobs)
+    ]
+    for process in workers:
+        process.start()
+
+    finished = {}
+    running = jobs
+
+    def receive(block):
+        nonlocal running
+        try:
+            kind, index, value = results.get(block, timeout=1)
+        except queue.Empty:
+            # Unexpected errors end a worker with its traceback on stderr
+            for process in workers:
+                if process.exitcode:
+                    raise AugurError(f"A curate worker exited with code {process.exitcode}.")
+            return
+        if kind == "error":
+            raise AugurError(value)
+        if kind == "done":
+            running -= 1
+        else:
+            finished[index] = value
+
+    def put(task):
+        # Keep receiving while the task queue is full, so that errors of the workers surface
+        while True:
+            try:
+                tasks.put(task, timeout=1)
+                return
+            except queue.Full:
+                receive(False)
+
+    try:
+        next_index = 0
+        submitted = 0
+        for batch in iter_batches(lines):
+            # Limit the number of batches in flight to bound memory use
+            while submitted - next_index >= 2 * jobs:
+                while next_index not in finished:
+                    receive(True)
+                yield from finished.pop(next_index)
+                next_index += 1
+            put((submitted, batch))
+            submitted += 1
+
+        for _ in workers:
+            put(None)
+
+        while next_index < submitted:
+            while next_index not in finished:
+                receive(True)
+            yield from finished.pop(next_index)
+            next_index += 1
+
+        while running:
+            receive(True)
+    finally:
+        for process in workers:
+            if process.is_alive() and running:
+                process.terminate()
+            process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--jobs", type=int, default=1,
+        help="Number of processes curating records (default: 1)")
+    parser.add_argument("--cache",
+        help="SQLite cache of curated records to reuse for unchanged records and to update")
+    parser.add_argument("--cache-key-field",
+        help="Input record field that identifies a record version, used as the key of the cache")
+    parser.add_argument("steps", nargs=argparse.REMAINDER,
+        help=f"Curate steps separated by {STEP_SEPARATOR!r}")
+    args = parser.parse_args()
+
+    try:
+        step_argvs = split_steps(args.steps)
+        steps = parse_steps(step_argvs)
+        chain_output_args = output_args(steps)
+
+        cache_args = None
+        cache_writer = None
+        if args.cache:
+            if not args.cache_key_field:
+                raise AugurError("The --cache-key-field option is required with --cache.")
+            fingerprint = chain_fingerprint(step_argvs, steps)
+            previous = args.cache if cache_fingerprint(args.cache) == fingerprint else None
+            if previous is None:
+                print_err(f"Curation cache {args.cache!r} is missing or out of date, curating all records.")
+            cache_args = (previous, args.cache_key_field, chain_output_args.output_seq_field)
+            cache_writer = CacheWriter(args.cache, fingerprint)
+
+        if args.jobs <= 1:
+            results = run_serial(step_argvs, cache_args, sys.stdin)
+        else:
+            results = run_parallel(step_argvs, cache_args, sys.stdin, args.jobs)
+
+        counts = Counter()
+
+        def records():
+            for curated, entry, cached in results:
+                counts[cached] += 1
+                if cache_writer is not None and entry is not None:
+                    cache_writer.add(entry)
+                yield curated
+
+        try:
+            # The output of all batches together is validated once more here
+            write_outputs(validate_records(records(), "curate-chain", False), chain_output_args)
+        except BaseException:
+            if cache_writer is not None:
+                cache_writer.discard()
+            raise
+
+        if cache_writer is not None:
+            cache_writer.commit()
+            print_err(f"Curated {counts[False]} records, reused {counts[True]} records from the cache.")
+    except AugurError as e:
+        print_err(f"ERROR: {e}")
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+"""
+Download Pathoplexus released data and verify it in a single pass.
+
+The zstd-compressed response is streamed to disk while the same bytes are
+hashed with sha256 and decompressed in memory to count the newline-terminated
+records. The count is checked against the `x-total-records` response header as
+the data arrives, and a manifest with the count, hash and response headers is
+written next to the download so that later steps do not need to rescan it.
+
+With --snapshot, the records are also kept in a local snapshot store: a file of
+individually compressed records plus a SQLite index of accession -> version ->
+record offset. The download is requested conditionally on the ETag of the last
+snapshot. If the server reports that nothing changed, the output is restored
+from a copy of the last download kept in the store, so that it is byte-identical
+to what the server sent, or else rebuilt from the records. Otherwise only records
+that are new or changed since the last snapshot are added to the store.
+
+The manifest records the sha256 of the compressed file and of the decompressed
+NDJSON, which is the same for a download and a rebuild of the same records.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import urllib.error
+import urllib.request
+
+import zstandard as zstd
+
+CHUNK_SIZE = 1024 * 1024
+SNAPSHOT_VERSION = "1"
+
+
+class RecordCountMismatch(Exception):
+    pass
+
+
+class SnapshotStore:
+    """
+    Local snapshot of released records, kept in `directory`.
+
+    Records are stored as independent zstd frames in a data file, indexed by
+    accession and version in `index.sqlite` together with a digest of the
+    record, its offset and length in the data file and its position in the
+    last download. The `info` table holds the URL, ETag, record count and
+    hashes of the last download, of which a copy is kept in `download.ndjson.zst`.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.connection = sqlite3.connect(os.path.join(directory, "index.sqlite"))
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS records (accession TEXT, version INTEGER, digest BLOB, "
+                "offset INTEGER, length INTEGER, position INTEGER, "
+                "PRIMARY KEY (accession, version)) WITHOUT ROWID"
+            )
+        self.info = dict(self.connection.execute("SELECT key, value FROM info"))
+
+        # Start over if the snapshot was written by an incompatible version
+        if self.info and self.info.get('snapshot_version') != SNAPSHOT_VERSION:
+            with self.connection:
+                self.connection.execute("DELETE FROM info")
+                self.connection.execute("DELETE FROM records")
+            self.info = {}
+
+    @property
+    def data_path(self):
+        return os.path.join(self.directory, self.info.get('data_file', "records-0.zst"))
+
+    @property
+    def download_path(self):
+        return os.path.join(self.directory, "download.ndjson.zst")
+
+    @property
+    def total(self):
+        return int(self.info['total'])
+
+    def etag(self, url):
+        """ETag of the last download of `url`, or None if there is no usable snapshot of it."""
+        if self.info.get('url') != url or not os.path.exists(self.data_path):
+            return None
+        return self.info.get('etag')
+
+    def update(self):
+        return SnapshotUpdate(self)
+
+    def compact(self):
+        """Rewrite the records that are still indexed to a new data file, in download order."""
+        generation = int(self.info.get('generation', 0)) + 1
+        data_file = f"records-{generation}.zst"
+        old_path = self.data_path
+        rows = []
+        offset = 0
+        with open(old_path, 'rb') as old, open(os.path.join(self.directory, data_file), 'wb') as new:
+            query = "SELECT accession, version, offset, length FROM records ORDER BY position"
+            for accession, version, old_offset, length in self.connection.execute(query).fetchall():
+                old.seek(old_offset)
+                new.write(old.read(length))
+                rows.append((offset, accession, version))
+                offset += length
+
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE records SET offset = ? WHERE accession = ? AND version = ?", rows
+            )
+            self.set_info(generation=str(generation), data_file=data_file)
+        os.remove(old_path)
+
+    def set_info(self, **info):
+        self.connection.executemany("INSERT OR REPLACE INTO info VALUES (?, ?)", info.items())
+        self.info.update(info)
+
+    def restore(self, output_file):
+        """
+        Copy the last download to output_file, checking it against the hash recorded with it.
+
+        Args:
+            output_file: Path to the output .ndjson.zst file
+
+        Returns:
+            Tuple of number of records and digests of the output, or None if there
+            is no intact copy of the last download
+        """
+        if not os.path.exists(self.download_path):
+            return None
+        sha256 = hashlib.sha256()
+        size = 0
+        with open(self.download_path, 'rb') as src, open(output_file, 'wb') as dst:
+            while chunk := src.read(CHUNK_SIZE):
+                dst.write(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+        if sha256.hexdigest() != self.info.get('download_sha256'):
+            return None
+        return self.total, {
+            "sha256": self.info['download_sha256'],
+            "bytes": size,
+            "ndjson_sha256": self.info['ndjson_sha256'],
+        }
+
+    def rebuild(self, output_file):
+        """
+        Write all records of the snapshot, in download order, to a zstd-compressed NDJSON file.
+
+        The decompressed data is the same as the last download, but the compressed
+        bytes generally are not.
+
+        Args:
+            output_file: Path to the output .ndjson.zst file
+
+        Returns:
+            Tuple of number of records and digests of the output
+        """
+        decompressor = zstd.ZstdDecompressor()
+        ndjson_sha256 = hashlib.sha256()
+        records = 0
+        with open(self.data_path, 'rb') as data, open(output_file, 'wb') as fh:
+            with zstd.ZstdCompressor(threads=-1).stream_writer(fh, closefd=False) as writer:
+                query = "SELECT offset, length FROM records ORDER BY position"
+                for offset, length in self.connection.execute(query):
+                    data.seek(offset)
+                    record = decompressor.decompress(data.read(length)) + b'\n'
+                    writer.write(record)
+                    ndjson_sha256.update(record)
+                    records += 1
+
+        sha256 = hashlib.sha256()
+        with open(output_file, 'rb') as fh:
+            while chunk := fh.read(CHUNK_SIZE):
+                sha256.update(chunk)
+        return records, {
+            "sha256": sha256.hexdigest(),
+            "bytes": os.path.getsize(output_file),
+            "ndjson_sha256": ndjson_sha256.hexdigest(),
+        }
+
+
+class SnapshotUpdate:
+    """
+    Apply a download to a snapshot store.
+
+    Decompressed data is fed in as it arrives. Records whose digest is already
+    in the index are kept where they are. Only new or changed records are
+    parsed for their accession and version and appended to the data file. The
+    index is replaced on commit(); discard() drops the appended records.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.known = {
+            digest: (accession, version, offset, length)
+            for digest, accession, version, offset, length
+            in store.connection.execute("SELECT digest, accession, version, offset, length FROM records")
+        }
+        self.rows = {}
+        self.added = 0
+        self.pending = b''
+        self.compressor = zstd.ZstdCompressor()
+        self.data = open(store.data_path, 'ab')
+        self.start = self.offset = self.data.tell()
+
+    def feed(self, data):
+        lines = (self.pending + data).split(b'\n')
+        self.pending = lines.pop()
+        for line in lines:
+            self.add(line)
+
+    def add(self, line):
+        if not line:
+            return
+
+        digest = hashlib.blake2b(line, digest_size=16).digest()
+        known = self.known.get(digest)
+        if known is not None:
+            accession, version, offset, length = known
+        else:
+            metadata = json.loads(line)['metadata']
+            accession, version = metadata['accession'], int(metadata['version'])
+            frame = self.compressor.compress(line)
+            self.data.write(frame)
+            offset, length = self.offset, len(frame)
+            self.offset += length
+            self.added += 1
+
+        self.rows[(accession, version)] = (digest, offset, length, len(self.rows))
+
+    def commit(self, url, etag, total, output_file, digests):
+        """
+        Replace the index with the records of this download and keep a copy of the download.
+
+        Returns:
+            Tuple of number of new or changed records and number of removed records
+        """
+        self.add(self.pending)
+        self.pending = b''
+        self.data.close()
+
+        store = self.store
+        # The copy is only restored if it matches the hash in the index, so a copy
+        # replaced without the index being updated is never used
+        fd, tmp_path = tempfile.mkstemp(dir=store.directory, suffix=".zst")
+        os.close(fd)
+        try:
+            shutil.copyfile(output_file, tmp_path)
+            os.replace(tmp_path, store.download_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        with store.connection:
+            store.connection.execute("DELETE FROM records")
+            store.connection.executemany(
+                "INSERT INTO records VALUES (?, ?, ?, ?, ?, ?)",
+                (key + row for key, row in self.rows.items())
+            )
+            store.set_info(
+                snapshot_version=SNAPSHOT_VERSION, url=url, etag=etag or "", total=str(total),
+                download_sha256=digests["sha256"], ndjson_sha256=digests["ndjson_sha256"],
+            )
+
+        # Reclaim space once most of the data file is replaced records
+        live = sum(row[2] for row in self.rows.values())
+        if os.path.getsize(store.data_path) > 2 * live:
+            store.compact()
+
+        kept = {(accession, version) for accession, version, _, _ in self.known.values()}
+        return self.added, len(kept - self.rows.keys())
+
+    def discard(self):
+        self.data.close()
+        os.truncate(self.store.data_path, self.start)
+
+
+def write_headers(response, headers_file):
+    """
+    Write the status line and headers of a response like `curl -D`.
+
+    Args:
+        response: HTTP response or HTTPError
+        headers_file: Path to the output headers file
+    """
+    version = "HTTP/1.0" if getattr(response, 'version', 11) == 10 else "HTTP/1.1"
+    with open(headers_file, 'w', newline='') as fh:
+        fh.write(f"{version} {response.status} {response.reason}\r\n")
+        for name, value in response.headers.items():
+            fh.write(f"{name}: {value}\r\n")
+        fh.write("\r\n")
+
+
+def expected_record_count(headers):
+    """
+    Get the record count announced by the server.
+
+    Args:
+        headers: Response headers
+
+    Returns:
+        Number of records from the `x-total-records` header
+    """
+    value = (headers.get('x-total-records') or "").strip()
+    if not value.isdigit():
+        raise RecordCountMismatch(f"Missing or invalid x-total-records header: {value!r}")
+    return int(value)
+
+
+def download(response, output_file, expected, update=None):
+    """
+    Stream a zstd-compressed NDJSON response to disk, counting records and
+    hashing the compressed and the decompressed bytes on the way.
+
+    Args:
+        response: HTTP response with a read(size) method
+        output_file: Path to the output .ndjson.zst file
+        expected: Expected number of records, or None to skip the check
+        update: Optional SnapshotUpdate to feed the decompressed data to
+
+    Returns:
+        Tuple of number of records and digests: sha256 hex digest and number of
+        bytes of the compressed file and sha256 hex digest of the decompressed NDJSON
+    """
+    decompressor = zstd.ZstdDecompressor().decompressobj(read_across_frames=True)
+    sha256 = hashlib.sha256()
+    ndjson_sha256 = hashlib.sha256()
+    records = 0
+    size = 0
+    last_byte = b'\n'
+
+    with open(output_file, 'wb') as fh:
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+
+            fh.write(chunk)
+            sha256.update(chunk)
+            size += len(chunk)
+
+            data = decompressor.decompress(chunk)
+            if data:
+                ndjson_sha256.update(data)
+                records += data.count(b'\n')
+                last_byte = data[-1:]
+                if update is not None:
+                    update.feed(data)
+
+            # Stop early instead of downloading the rest of an oversized dump
+            if expected is not None and records > expected:
+                raise RecordCountMismatch(f"Mismatch: expected {expected}, got at least {records}")
+
+    # Last record without a trailing newline
+    if last_byte != b'\n':
+        records += 1
+
+    return records, {"sha256": sha256.hexdigest(), "bytes": size, "ndjson_sha256": ndjson_sha256.hexdigest()}
+
+
+def check_record_count(records, expected):
+    print(f"Actual records:   {records}", file=sys.stderr)
+    print(f"Expected records: {expected}", file=sys.stderr)
+    if records != expected:
+        raise RecordCountMismatch(f"Mismatch: expected {expected}, got {records}")
+
+
+def fetch(url, output_file, headers_file, manifest_file, snapshot_dir=None):
+    """
+    Download released data from Pathoplexus, verify the record count and
+    write a manifest.
+
+    Args:
+        url: URL of the get-released-data endpoint
+        output_file: Path to the output .ndjson.zst file
+        headers_file: Path to the output headers file
+        manifest_file: Path to the output manifest JSON file
+        snapshot_dir: Optional directory of the snapshot store
+    """
+    store = SnapshotStore(snapshot_dir) if snapshot_dir else None
+    request = urllib.request.Request(url)
+    etag = store.etag(url) if store is not None else None
+    if etag:
+        request.add_header('If-None-Match', etag)
+
+    print(f"Downloading: {url}", file=sys.stderr)
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        if e.code != 304 or not etag:
+            raise
+        with e:
+            write_headers(e, headers_file)
+            headers = dict(e.headers.items())
+        expected = store.total
+        restored = store.restore(output_file)
+        if restored is not None:
+            print(f"Not modified since the last snapshot, restored the last download from {snapshot_dir}", file=sys.stderr)
+            records, digests = restored
+        else:
+            print(f"Not modified since the last snapshot, rebuilding from the records in {snapshot_dir}", file=sys.stderr)
+            records, digests = store.rebuild(output_file)
+        check_record_count(records, expected)
+    else:
+        with response:
+            write_headers(response, headers_file)
+            headers = dict(response.headers.items())
+            expected = expected_record_count(response.headers)
+            update = store.update() if store is not None else None
+            try:
+                records, digests = download(response, output_file, expected, update)
+                check_record_count(records, expected)
+            except BaseException:
+                if update is not None:
+                    update.discard()
+                raise
+
+        if update is not None:
+            added, removed = update.commit(url, response.headers.get('ETag'), expected, output_file, digests)
+            print(f"Snapshot: {added} new or changed records, {removed} removed", file=sys.stderr)
+
+    manifest = {
+        "url": url,
+        "records": records,
+        **digests,
+        "headers": headers,
+    }
+    with open(manifest_file, 'w') as fh:
+        json.dump(manifest, fh, indent=2)
+        fh.write("\n")
+
+    print("OK: record counts match.", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Download Pathoplexus released data, verifying the record count in the same pass"
+    )
+    parser.add_argument(
+        '--url',
+        required=True,
+        help='URL of the get-released-data endpoint (zstd compressed)'
+    )
+    parser.add_argument(
+        '--output',
+        required=True,
+        help='Output NDJSON file (compressed with zstd)'
+    )
+    parser.add_argument(
+        '--headers',
+        required=True,
+        help='Output file for the response headers'
+    )
+    parser.add_argument(
+        '--manifest',
+        required=True,
+        help='Output JSON manifest with record count, sha256 of the compressed and decompressed data and headers'
+    )
+    parser.add_argument(
+        '--snapshot',
+        help='Directory of a local snapshot store used to fetch only changes since the last download'
+    )
+
+    args = parser.parse_args()
+
+    try:
+        fetch(args.url, args.output, args.headers, args.manifest, args.snapshot)
+    except urllib.error.HTTPError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    except RecordCountMismatch as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 """
 Add continent information to NDJSON records based on country.
+
+With --flatten, the input is the raw Pathoplexus NDJSON, which is flattened
+(latest versions only, metadata without the dropped fields plus the sequence)
+in the same pass.
 """
 import argparse
 import json
+import multiprocessing
 import sys
+from collections import Counter, deque
 
 import zstandard as zstd
 
@@ -103,13 +109,23 @@ for continent, countries in CONTINENT_COUNTRIES.items():
 for location in SPECIAL_LOCATIONS:
     COUNTRY_TO_CONTINENT[location] = None
 
+# Lowercased names for case-insensitive lookups (the first entry wins on clashes)
+COUNTRY_TO_CONTINENT_LOWER = {}
+for country, continent in COUNTRY_TO_CONTINENT.items():
+    COUNTRY_TO_CONTINENT_LOWER.setdefault(country.lower(), continent)
+
+# Size of the line-aligned blocks the decompressed input is split into
+BLOCK_SIZE = 4 * 1024 * 1024
 
-def get_continent(country):
+
+def get_continent(country, unknown_countries=None):
     """
     Get continent for a country.
 
     Args:
         country: Country name string
+        unknown_countries: Optional Counter of countries not found, which is
+            updated and also used to skip repeated lookups of those countries
 
     Returns:
         Continent name or None if country not found or is a special location (ocean, etc.)
@@ -121,90 +137,186 @@ def get_continent(country):
     if country in COUNTRY_TO_CONTINENT:
         return COUNTRY_TO_CONTINENT[country]
 
+    if unknown_countries is not None and country in unknown_countries:
+        unknown_countries[country] += 1
+        return None
+
     # Try case-insensitive lookup
     country_lower = country.lower()
-    for known_country, cont in COUNTRY_TO_CONTINENT.items():
-        if known_country.lower() == country_lower:
-            return cont
+    if country_lower in COUNTRY_TO_CONTINENT_LOWER:
+        return COUNTRY_TO_CONTINENT_LOWER[country_lower]
 
-    # Country not found - print warning to stderr but continue processing
-    print(f"Warning: Unknown country '{country}'", file=sys.stderr)
+    # Country not found - counted for the summary at the end of the run
+    if unknown_countries is not None:
+        unknown_countries[country] += 1
     return None
 
 
-def process_records(input_file, output_file):
+def flatten_entry(entry, drop_fields):
+    """
+    Flatten a Pathoplexus entry into a record of its metadata and sequence.
+
+    Args:
+        entry: Entry dict parsed from a line of the Pathoplexus NDJSON
+        drop_fields: Set of metadata fields to leave out of the record
+
+    Returns:
+        Record dict, or None if the entry is not the latest version
+    """
+    metadata = entry.get('metadata')
+    if not metadata or metadata.get('versionStatus') != "LATEST_VERSION":
+        return None
+
+    record = {key: value for key, value in metadata.items() if key not in drop_fields}
+    sequences = entry.get('unalignedNucleotideSequences')
+    record['sequence'] = sequences.get('main') if sequences else None
+    return record
+
+
+def transform_record(record, unknown_countries=None):
+    """
+    Add continent field and clean up values of a record in place.
+
+    Args:
+        record: Record dict parsed from an NDJSON line
+        unknown_countries: Optional Counter of countries not found
+    """
+    # Add continent field based on country
+    country = record.get('geoLocCountry')
+    continent = get_continent(country, unknown_countries)
+    record['geoLocContinent'] = continent
+
+    # Replace `null` values with empty strings
+    # `augur curate` doesn't like nulls
+    # Also replace newlines in string values to prevent TSV corruption
+    for key, value in record.items():
+        if value is None:
+            record[key] = ""
+        elif isinstance(value, str) and '\n' in value:
+            record[key] = value.replace('\n', ' ').replace('\r', '')
+
+    # Replace Viet Nam with Vietnam
+    if record.get('geoLocCountry') == "Viet Nam":
+        record['geoLocCountry'] = "Vietnam"
+
+
+def transform_block(block, drop_fields=None):
+    """
+    Transform a block of complete NDJSON lines.
+
+    Args:
+        block: Bytes of one or more NDJSON lines
+        drop_fields: If not None, lines are Pathoplexus entries to flatten,
+            leaving out these metadata fields
+
+    Returns:
+        Bytes of the transformed NDJSON lines, with blank lines dropped, and a
+        Counter of the unknown countries in the block
+    """
+    output = []
+    unknown_countries = Counter()
+    for line_bytes in block.split(b'\n'):
+        line = line_bytes.decode('utf-8').strip()
+
+        if not line:
+            continue
+
+        record = json.loads(line)
+        if drop_fields is not None:
+            record = flatten_entry(record, drop_fields)
+            if record is None:
+                continue
+        transform_record(record, unknown_countries)
+        output.append(json.dumps(record) + '\n')
+
+    return ''.join(output).encode('utf-8'), unknown_countries
+
+
+def iter_blocks(reader, block_size=BLOCK_SIZE):
+    """
+    Yield line-aligned blocks of a binary stream read in chunks.
+
+    Each chunk is split once at its last newline and only the trailing partial
+    line is carried over to the next chunk, so the cost is linear in the size
+    of the stream.
+
+    Args:
+        reader: Binary stream with a read(size) method
+        block_size: Number of bytes to read at a time
+    """
+    remainder = b''
+    while True:
+        chunk = reader.read(block_size)
+        if not chunk:
+            break
+        block, newline, remainder = (remainder + chunk).rpartition(b'\n')
+        if newline:
+            yield block
+
+    # Last line without a trailing newline
+    if remainder:
+        yield remainder
+
+
+def process_records(input_file, output_file, jobs=1, drop_fields=None):
     """
     Read NDJSON, add continent field, write output.
 
+    With more than one job, blocks are transformed in a process pool and
+    written in their original order, giving the same output as a single job.
+
     Args:
         input_file: Path to input .ndjson.zst file
         output_file: Path to output .ndjson.zst file
+        jobs: Number of processes transforming records
+        drop_fields: If not None, flatten Pathoplexus entries, leaving out
+            these metadata fields
     """
     dctx = zstd.ZstdDecompressor()
-    cctx = zstd.ZstdCompressor()
+    cctx = zstd.ZstdCompressor(threads=-1)
+    unknown_countries = Counter()
+
+    def write(result):
+        output, block_unknown_countries = result
+        writer.write(output)
+        unknown_countries.update(block_unknown_countries)
 
     with open(input_file, 'rb') as ifh, open(output_file, 'wb') as ofh:
         with dctx.stream_reader(ifh) as reader, cctx.stream_writer(ofh) as writer:
-            # Stream in chunks and process line by line
-            buffer = b''
-            chunk_size = 1024 * 1024  # 1MB chunks
-
-            while True:
-                chunk = reader.read(chunk_size)
-                if not chunk:
-                    break
-
-                buffer += chunk
-
-                # Process complete lines
-                while b'\n' in buffer:
-                    line_bytes, buffer = buffer.split(b'\n', 1)
-                    line = line_bytes.decode('utf-8').strip()
-
-                    if not line:
-                        continue
-
-                    record = json.loads(line)
-
-                    # Add continent field based on country
-                    country = record.get('geoLocCountry')
-                    continent = get_continent(country)
-                    record['geoLocContinent'] = continent
-
-                    # Replace `null` values with empty strings
-                    # `augur curate` doesn't like nulls
-                    # Also replace newlines in string values to prevent TSV corruption
-                    for key, value in record.items():
-                        if value is None:
-                            record[key] = ""
-                        elif isinstance(value, str) and '\n' in value:
-                            record[key] = value.replace('\n', ' ').replace('\r', '')
-
-                    # Replace Viet Nam with Vietnam
-                    if record.get('geoLocCountry') == "Viet Nam":
-                        record['geoLocCountry'] = "Vietnam"
-
-                    # Write modified record
-                    output_line = json.dumps(record) + '\n'
-                    writer.write(output_line.encode('utf-8'))
-
-            # Process any remaining data in buffer
-            if buffer.strip():
-                line = buffer.decode('utf-8').strip()
-                record = json.loads(line)
-                country = record.get('geoLocCountry')
-                continent = get_continent(country)
-                record['geoLocContinent'] = continent
-
-                # Replace `null` values with empty strings and strip newlines
-                for key, value in record.items():
-                    if value is None:
-                        record[key] = ""
-                    elif isinstance(value, str) and '\n' in value:
-                        record[key] = value.replace('\n', ' ').replace('\r', '')
-
-                output_line = json.dumps(record) + '\n'
-                writer.write(output_line.encode('utf-8'))
+            if jobs <= 1:
+                for block in iter_blocks(reader):
+                    write(transform_block(block, drop_fields))
+            else:
+                with multiprocessing.Pool(jobs) as pool:
+                    # Limit the number of blocks in flight to bound memory use
+                    pending = deque()
+                    for block in iter_blocks(reader):
+                        pending.append(pool.apply_async(transform_block, (block, drop_fields)))
+                        if len(pending) >= 2 * jobs:
+                            write(pending.popleft().get())
+                    while pending:
+                        write(pending.popleft().get())
+
+    print_unknown_countries(unknown_countries)
+
+
+def print_unknown_countries(unknown_countries):
+    """
+    Print one summary of the unknown countries and their record counts to stderr.
+
+    Args:
+        unknown_countries: Counter of countries not found
+    """
+    if not unknown_countries:
+        return
+
+    print(
+        f"Warning: {sum(unknown_countries.values())} records with "
+        f"{len(unknown_countries)} unknown countries:",
+        file=sys.stderr
+    )
+    for country, count in unknown_countries.most_common():
+        print(f"  '{country}': {count}", file=sys.stderr)
 
 
 def main():
@@ -221,10 +333,28 @@ def main():
         required=True,
         help='Output NDJSON file (compressed with zstd)'
     )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help='Number of processes transforming records (default: 1)'
+    )
+    parser.add_argument(
+        '--flatten',
+        action='store_true',
+        help='Input is the raw Pathoplexus NDJSON, to be flattened to latest-version metadata and sequence'
+    )
+    parser.add_argument(
+        '--drop-fields',
+        nargs='*',
+        default=[],
+        help='Metadata fields to drop when flattening'
+    )
 
     args = parser.parse_args()
 
-    process_records(args.input, args.output)
+    drop_fields = frozenset(args.drop_fields) if args.flatten else None
+    process_records(args.input, args.output, args.jobs, drop_fields)
 
 
 if __name__ == '__main__':
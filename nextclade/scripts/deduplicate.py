@@ -5,12 +5,49 @@ python3 scripts/deduplicate.py \
 --sequences {input.sequences} \
 --output {output}
 """
+import gzip
+import hashlib
 import itertools
+import json
 import multiprocessing
+import os
+import tempfile
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from enum import Enum
 from functools import partial
+from multiprocessing import shared_memory
+from typing import Annotated, List, Optional
 
+import numpy as np
 import typer
 from Bio import SeqIO
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+
+class Engine(str, Enum):
+    pairwise = "pairwise"
+    trie = "trie"
+
+class Backend(str, Enum):
+    python = "python"
+    numpy = "numpy"
+
+# 4-bit nucleotide codes: two sites conflict iff their codes share no bit,
+# so everything that is not ACGT (N, gaps, ambiguity codes) matches anything
+NUCLEOTIDE_CODES = {"A": 1, "C": 2, "G": 4, "T": 8}
+WILDCARD_CODE = 15
+ENCODING_TABLE = bytes(NUCLEOTIDE_CODES.get(chr(b), WILDCARD_CODE) for b in range(256))
+
+# Rows compared per vectorised block, so that long candidate lists can still stop early
+COMPARISON_BLOCK = 1024
+
+# Sequences per work item handed to shared-memory workers
+RANGE_SIZE = 64
+
+# Bump when the layout of the incremental state file changes
+STATE_VERSION = 1
 
 
 def informative_sites(sequence: str) -> int:
@@ -71,12 +108,517 @@ def informative_indexes_sorted_by_entropy(composition: list) -> list:
     site_information = sorted(site_information.items(), key=lambda x: x[1], reverse=True)
     return [x[0] for x in site_information]
 
+def read_alignment_matrix(input: str):
+    """
+    Read an alignment into one contiguous uint8 matrix of nucleotide codes
+    Returns the list of IDs and the matrix with one row per sequence
+    """
+    ids = []
+    buffer = bytearray()
+    with open(input, "r") as f:
+        for title, seq in SimpleFastaParser(f):
+            ids.append(title.split(None, 1)[0])
+            buffer += seq.encode().translate(ENCODING_TABLE)
+    matrix = np.frombuffer(buffer, dtype=np.uint8).reshape(len(ids), -1)
+    return ids, matrix
+
+def composition_per_site_matrix(matrix, chunk_size: int = 1024):
+    """
+    Count A, C, G and T in each column of a code matrix
+    Returns an array of shape (4, number of sites)
+    """
+    counts = np.zeros((len(NUCLEOTIDE_CODES), matrix.shape[1]), dtype=np.int64)
+    for start in range(0, matrix.shape[0], chunk_size):
+        chunk = matrix[start:start + chunk_size]
+        for k, code in enumerate(NUCLEOTIDE_CODES.values()):
+            counts[k] += np.count_nonzero(chunk == code, axis=0)
+    return counts
+
+def mismatch_prob_per_site_matrix(counts, num_sequences: int):
+    """
+    Vectorised mismatch_prob_per_site: sum over pairs of distinct nucleotides
+    of the product of their frequencies
+    """
+    total = counts.sum(axis=0)
+    pairs = (total * total - (counts * counts).sum(axis=0)) // 2
+    return pairs / (num_sequences * num_sequences)
+
+def informative_indexes_sorted_by_entropy_matrix(counts, num_sequences: int):
+    """
+    Vectorised informative_indexes_sorted_by_entropy
+    """
+    prob = mismatch_prob_per_site_matrix(counts, num_sequences)
+    informative = np.flatnonzero(prob > 0)
+    return informative[np.argsort(-prob[informative], kind="stable")]
+
+def informative_sites_matrix(matrix, chunk_size: int = 1024):
+    """
+    Count number of ACGT characters in each row of a code matrix
+    """
+    return np.concatenate([
+        np.count_nonzero(matrix[start:start + chunk_size] != WILDCARD_CODE, axis=1)
+        for start in range(0, matrix.shape[0], chunk_size)
+    ])
+
+def all_identical_rows(rows, row):
+    """
+    Boolean mask of the rows identical (up to Ns) to row
+    """
+    return np.concatenate([
+        np.all(rows[start:start + COMPARISON_BLOCK] & row, axis=1)
+        for start in range(0, len(rows), COMPARISON_BLOCK)
+    ] or [np.zeros(0, dtype=bool)])
+
+def first_identical_row(rows, row):
+    """
+    Position of the first row identical (up to Ns) to row, or None
+    Compares in blocks to short circuit at the first block with a hit
+    """
+    for start in range(0, len(rows), COMPARISON_BLOCK):
+        hits = np.flatnonzero(np.all(rows[start:start + COMPARISON_BLOCK] & row, axis=1))
+        if len(hits):
+            return start + int(hits[0])
+    return None
+
+def match_candidates(rest, yang_idx: int, candidates):
+    """
+    Earliest candidate identical (up to Ns) to yang on the remaining sites
+    Returns its index, or None, and the number of pairs compared
+    """
+    if not len(candidates):
+        return None, 0
+    hit = first_identical_row(rest[candidates], rest[yang_idx])
+    if hit is None:
+        return None, len(candidates)
+    # Blocks after the one containing the hit are never compared
+    return int(candidates[hit]), min(len(candidates), (hit // COMPARISON_BLOCK + 1) * COMPARISON_BLOCK)
+
+def find_duplicates_trie_matrix(ids, sites, signature_sites: int):
+    """
+    Trie engine on a code matrix whose columns are the informative sites
+    sorted by entropy
+    Returns the representative index of each removed sequence and the number of pairs compared
+    """
+    trie = SignatureTrie(wildcard=WILDCARD_CODE)
+    keys = sites[:, :signature_sites]
+    rest = sites[:, signature_sites:]
+    representatives = {}
+    comparisons = 0
+
+    for yang_idx in range(len(ids)):
+        key = bytes(keys[yang_idx])
+        if key:
+            candidates = np.asarray(trie.candidates(key), dtype=np.intp)
+        else:
+            candidates = np.arange(yang_idx)
+
+        ying_idx, compared = match_candidates(rest, yang_idx, candidates)
+        comparisons += compared
+        if ying_idx is not None:
+            representatives[yang_idx] = ying_idx
+
+        if key:
+            trie.insert(key, yang_idx)
+
+    return representatives, comparisons
+
+def find_duplicates_pairwise_matrix(ids, sites, num_processes: int):
+    """
+    Pairwise engine on a code matrix whose columns are the informative sites,
+    comparing batches of sequences against all later ones in parallel
+    Returns the representative index of each removed sequence and the number of pairs compared
+    """
+    num_sequences = len(ids)
+    batch_size = max(1, num_sequences // (num_processes * 5))  # Smaller batches for better load balancing
+    batches = [
+        list(range(start, min(start + batch_size, num_sequences - 1)))
+        for start in range(0, num_sequences - 1, batch_size)
+    ]
+    with multiprocessing.Pool(
+        processes=num_processes,
+        initializer=init_worker,
+        initargs=(sites,),
+    ) as pool:
+        results = pool.map(process_pairwise_batch, batches)
+
+    # Keep the earliest ying for each yang
+    representatives = {}
+    for yang_idx, ying_idx in sorted(itertools.chain.from_iterable(results)):
+        representatives.setdefault(yang_idx, ying_idx)
+    return representatives, num_sequences * (num_sequences - 1) // 2
+
+# State of a worker, set once by init_worker
+_worker = {}
+
+def init_worker(rest):
+    """
+    Set the matrix view that process_range, process_pairwise_batch and
+    process_neighbours compare rows of
+    Workers get their candidates with each work item, so they never hold a trie
+    """
+    _worker["rest"] = rest
+
+def attach_worker(shm_name: str, shape: tuple, signature_sites: int):
+    """
+    Pool initializer: attach to the shared code matrix without copying it
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker["shm"] = shm
+    init_worker(np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)[:, signature_sites:])
+
+def process_range(item: tuple):
+    """
+    Find the earliest identical sequence for each yang sequence in a range
+    The item is the first index of the range and the candidate indices of each
+    of its sequences, or None where every earlier sequence is a candidate
+    Returns a list of (yang, ying) index pairs and the number of pairs compared
+    """
+    start, candidate_lists = item
+    matches = []
+    comparisons = 0
+    for yang_idx, candidates in enumerate(candidate_lists, start):
+        if candidates is None:
+            candidates = np.arange(yang_idx)
+        ying_idx, compared = match_candidates(_worker["rest"], yang_idx, candidates)
+        comparisons += compared
+        if ying_idx is not None:
+            matches.append((yang_idx, ying_idx))
+    return matches, comparisons
+
+def process_pairwise_batch(batch_indices: list):
+    """
+    Compare each ying sequence in a batch against all later sequences,
+    one block of rows at a time
+    Returns a list of (yang, ying) index pairs
+    """
+    sites = _worker["rest"]
+    matches = []
+    for ying_idx in batch_indices:
+        for start in range(ying_idx + 1, len(sites), COMPARISON_BLOCK):
+            hits = np.flatnonzero(np.all(sites[start:start + COMPARISON_BLOCK] & sites[ying_idx], axis=1))
+            matches.extend((start + int(hit), ying_idx) for hit in hits)
+    return matches
+
+def process_neighbours(items: list):
+    """
+    Find the candidates identical to each of the given sequences
+    Each item is an index and its candidate indices
+    Returns a list of (index, identical candidate indices) and the number of pairs compared
+    """
+    rest = _worker["rest"]
+    neighbours = []
+    comparisons = 0
+    for idx, candidates in items:
+        hits = candidates[all_identical_rows(rest[candidates], rest[idx])]
+        comparisons += len(candidates)
+        neighbours.append((idx, [int(hit) for hit in hits]))
+    return neighbours, comparisons
+
+@contextmanager
+def shared_pool(sites, signature_sites: int, num_processes: int):
+    """
+    Pool whose workers attach to one shared-memory copy of the code matrix
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(1, sites.nbytes))
+    try:
+        shared = np.ndarray(sites.shape, dtype=np.uint8, buffer=shm.buf)
+        shared[:] = sites
+        del shared
+        with multiprocessing.Pool(
+            processes=num_processes,
+            initializer=attach_worker,
+            initargs=(shm.name, sites.shape, signature_sites),
+        ) as pool:
+            yield pool
+    finally:
+        shm.close()
+        shm.unlink()
+
+def imap_bounded(pool, func, items, num_processes: int):
+    """
+    Like pool.imap, but only submits a few items per worker ahead, so that
+    items generated lazily (with their candidate lists) are not all held at once
+    """
+    pending = deque()
+    for item in items:
+        if len(pending) >= 2 * num_processes:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (item,)))
+    while pending:
+        yield pending.popleft().get()
+
+def uses_trie(sites, engine: Engine, signature_sites: int) -> bool:
+    """
+    Without informative sites every key is empty, and every sequence is a candidate
+    """
+    return engine == Engine.trie and signature_sites > 0 and sites.shape[1] > 0
+
+def range_candidates(sites, engine: Engine, signature_sites: int):
+    """
+    Work items for process_range, with the earlier sequences in each sequence's
+    trie bucket as its candidates
+    The trie is only built here, in the main process, as the items are consumed
+    """
+    use_trie = uses_trie(sites, engine, signature_sites)
+    trie = SignatureTrie(wildcard=WILDCARD_CODE)
+    for start in range(0, len(sites), RANGE_SIZE):
+        candidate_lists = []
+        for idx in range(start, min(start + RANGE_SIZE, len(sites))):
+            if use_trie:
+                key = bytes(sites[idx, :signature_sites])
+                candidate_lists.append(np.asarray(trie.candidates(key), dtype=np.intp))
+                trie.insert(key, idx)
+            else:
+                candidate_lists.append(None)
+        yield start, candidate_lists
+
+def find_duplicates_shared(ids, sites, engine: Engine, signature_sites: int, num_processes: int):
+    """
+    Run either engine in a pool whose workers share the code matrix
+    The main process walks the trie and hands out small index ranges with their
+    candidates, so trie memory does not grow with the number of workers
+    Returns the representative index of each removed sequence and the number of pairs compared
+    """
+    if engine != Engine.trie:
+        signature_sites = 0
+    representatives = {}
+    comparisons = 0
+    with shared_pool(sites, signature_sites, num_processes) as pool:
+        items = range_candidates(sites, engine, signature_sites)
+        for matches, compared in imap_bounded(pool, process_range, items, num_processes):
+            comparisons += compared
+            representatives.update(matches)
+    return representatives, comparisons
+
+def content_hashes(matrix) -> list:
+    """
+    Hash of each encoded sequence, which is all that identity (up to Ns) depends on
+    """
+    return [hashlib.blake2b(row.tobytes(), digest_size=16).hexdigest() for row in matrix]
+
+def state_fingerprint(length: int, fingerprint_files: list) -> str:
+    """
+    Hash of the alignment length and the files (mask, reference) the alignment was made with
+    A state file with a different fingerprint is ignored and rebuilt from scratch
+    """
+    fingerprint = hashlib.sha256(str(length).encode())
+    for path in fingerprint_files:
+        with open(path, "rb") as f:
+            fingerprint.update(hashlib.sha256(f.read()).digest())
+    return fingerprint.hexdigest()
+
+def load_state(path: str, fingerprint: str) -> dict:
+    """
+    Neighbour lists by content hash from a previous run, or an empty dict
+    if there is no usable state
+    """
+    try:
+        with gzip.open(path, "rt") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        print(f"No state at {path}, doing a full rebuild")
+        return {}
+    except (EOFError, OSError, ValueError, zlib.error) as e:
+        # Truncated or corrupt file, e.g. from an interrupted run before writes were atomic
+        print(f"Could not read state at {path} ({e}), doing a full rebuild")
+        return {}
+    if state.get("version") != STATE_VERSION or state.get("fingerprint") != fingerprint:
+        print(f"State at {path} was made with a different mask, reference or alignment, rebuilding")
+        return {}
+    hashes = state["hashes"]
+    return {h: {hashes[i] for i in state["sequences"][h]["neighbours"]} for h in hashes}
+
+def save_state(path: str, fingerprint: str, ids: list, hashes: list, neighbours: dict, representatives: dict):
+    """
+    Write the cluster store: for each content hash its IDs, the representative
+    it was removed in favour of (if any) and the hashes it is identical to
+    """
+    hash_list = sorted(neighbours)
+    position = {h: i for i, h in enumerate(hash_list)}
+    sequences = {
+        h: {"ids": [], "representative": None, "neighbours": sorted(position[n] for n in neighbours[h])}
+        for h in hash_list
+    }
+    for idx, h in enumerate(hashes):
+        sequences[h]["ids"].append(ids[idx])
+        if idx in representatives:
+            sequences[h]["representative"] = ids[representatives[idx]]
+    # Write to a temporary file and move it into place, so that an interrupted
+    # run leaves the previous state rather than a truncated one
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".json.gz")
+    os.close(fd)
+    try:
+        with gzip.open(tmp_path, "wt") as f:
+            json.dump({
+                "version": STATE_VERSION,
+                "fingerprint": fingerprint,
+                "hashes": hash_list,
+                "sequences": sequences,
+            }, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def neighbour_candidates(sites, unique: list, stored, signature_sites: int):
+    """
+    Work items for process_neighbours, one per sequence with a new content hash
+    Its candidates are the sequences in its trie bucket that are stored, or new
+    and earlier, so that every pair involving a new sequence is compared once
+    The trie is only built here, in the main process, over one sequence per content hash
+    """
+    unique = np.asarray(unique, dtype=np.intp)
+    if uses_trie(sites, Engine.trie, signature_sites):
+        trie = SignatureTrie(wildcard=WILDCARD_CODE)
+        for idx in unique:
+            trie.insert(bytes(sites[idx, :signature_sites]), int(idx))
+    else:
+        trie = None
+    new_indices = unique[~stored[unique]]
+    for start in range(0, len(new_indices), RANGE_SIZE):
+        items = []
+        for idx in new_indices[start:start + RANGE_SIZE]:
+            if trie is None:
+                candidates = unique
+            else:
+                candidates = np.asarray(trie.candidates(bytes(sites[idx, :signature_sites])), dtype=np.intp)
+            items.append((int(idx), candidates[stored[candidates] | (candidates < idx)]))
+        yield items
+
+def find_duplicates_incremental(
+    ids, sites, hashes: list, known: dict, signature_sites: int, num_processes: int, shared: bool
+):
+    """
+    Identity up to Ns only depends on the two sequences, so pairs between
+    sequences already in the store are taken from it and only sequences with
+    a new content hash are compared, once per content hash, against the stored
+    and the earlier new sequences in their bucket
+    Every sequence still goes to its earliest identical sequence, so the
+    duplicates are the same as for a full run
+    Returns the representative index of each removed sequence, the neighbour
+    hashes of every content hash and the number of pairs compared
+    """
+    # Sequences with the same content are identical and have the same
+    # neighbours, so only the first occurrence of each content hash is compared
+    first_index = {}
+    for idx, h in enumerate(hashes):
+        first_index.setdefault(h, idx)
+    neighbours = {h: known[h] & first_index.keys() if h in known else set() for h in first_index}
+    stored = np.zeros(len(hashes), dtype=bool)
+    stored[[idx for h, idx in first_index.items() if h in known]] = True
+    new_count = len(first_index) - int(stored.sum())
+    print(f"{new_count} of {len(first_index)} distinct sequences are not in the state")
+
+    comparisons = 0
+    items = neighbour_candidates(sites, sorted(first_index.values()), stored, signature_sites)
+    if shared and new_count:
+        with shared_pool(sites, signature_sites, num_processes) as pool:
+            results = list(imap_bounded(pool, process_neighbours, items, num_processes))
+    else:
+        init_worker(sites[:, signature_sites:])
+        results = [process_neighbours(chunk) for chunk in items]
+    for found, compared in results:
+        comparisons += compared
+        for idx, hits in found:
+            for hit in hits:
+                neighbours[hashes[idx]].add(hashes[hit])
+                neighbours[hashes[hit]].add(hashes[idx])
+
+    # The earliest identical sequence is the earliest first occurrence among the neighbours and itself
+    representatives = {}
+    for yang_idx, h in enumerate(hashes):
+        ying_idx = min((first_index[n] for n in neighbours[h] | {h}), default=yang_idx)
+        if ying_idx < yang_idx:
+            representatives[yang_idx] = ying_idx
+
+    return representatives, neighbours, comparisons
+
+def signature(sequence: str, sites: list) -> tuple:
+    """
+    Characters of a sequence at the given sites
+    Anything that is not ACGT becomes the wildcard N
+    """
+    return tuple(sequence[i] if sequence[i] in "ACGT" else "N" for i in sites)
+
+class SignatureTrie:
+    """
+    Prefix tree over signatures of the highest entropy sites
+    Sequences with an N in their signature are stored on the wildcard branch,
+    so a lookup returns every earlier sequence that could be identical (up to Ns)
+    """
+    def __init__(self, wildcard="N"):
+        self.root = {}
+        self.wildcard = wildcard
+
+    def insert(self, key: tuple, index: int):
+        node = self.root
+        for c in key[:-1]:
+            node = node.setdefault(c, {})
+        node.setdefault(key[-1], []).append(index)
+
+    def candidates(self, key: tuple) -> list:
+        """
+        Indices of all stored sequences whose signature matches key up to Ns,
+        in insertion order
+        """
+        nodes = [self.root]
+        for c in key:
+            next_nodes = []
+            for node in nodes:
+                if c == self.wildcard:
+                    next_nodes.extend(node.values())
+                else:
+                    if c in node:
+                        next_nodes.append(node[c])
+                    if self.wildcard in node:
+                        next_nodes.append(node[self.wildcard])
+            nodes = next_nodes
+            if not nodes:
+                return []
+        if len(nodes) == 1:
+            return nodes[0]
+        return sorted(itertools.chain.from_iterable(nodes))
+
+def find_duplicates_trie(sequences, info_sites, signature_sites: int):
+    """
+    Find the same duplicates as the pairwise scan, but only compare sequences
+    that share a bucket in the signature trie
+    Returns the representative index of each removed sequence and the number of pairs compared
+    """
+    key_sites = info_sites[:signature_sites]
+    rest_sites = info_sites[signature_sites:]
+    trie = SignatureTrie()
+    representatives = {}
+    comparisons = 0
+
+    for yang_idx, yang_seq in enumerate(sequences):
+        key = signature(yang_seq["seq"], key_sites)
+        if key_sites:
+            candidates = trie.candidates(key)
+        else:
+            candidates = range(yang_idx)
+
+        # Candidates come before this sequence, so the first identical one is the pairwise scan's first hit
+        for ying_idx in candidates:
+            ying_seq = sequences[ying_idx]
+            comparisons += 1
+            if identical(ying_seq["seq"], yang_seq["seq"], rest_sites):
+                representatives[yang_idx] = ying_idx
+                break
+
+        if key_sites:
+            trie.insert(key, yang_idx)
+
+    return representatives, comparisons
+
 def process_batch(batch_indices, all_sequences, info_sites):
     """
     Process a batch of ying sequences against all potential duplicates
-    Returns a list of IDs to remove
+    Returns a list of (yang, ying) index pairs
     """
-    duplicates = []
+    matches = []
 
     for ying_idx in batch_indices:
         ying_seq = all_sequences[ying_idx]
@@ -86,32 +628,15 @@ def process_batch(batch_indices, all_sequences, info_sites):
             yang_seq = all_sequences[yang_idx]
 
             if identical(ying_seq["seq"], yang_seq["seq"], info_sites):
-                print(f"Removing {yang_seq['id']} as identical to {ying_seq['id']}")
-                duplicates.append(yang_seq["id"])
+                matches.append((yang_idx, ying_idx))
 
-    return duplicates
+    return matches
 
-def deduplicate(input: str, output: str, num_processes: int = 10):
+def find_duplicates_pairwise(sequences, info_sites, num_processes: int):
     """
-    Deduplicate sequences in a file
-    Args:
-        sequences: path to sequences file
-        output: path to output file
-        num_processes: number of cores to use
+    Compare every sequence against every later one, in parallel
+    Returns the representative index of each removed sequence and the number of pairs compared
     """
-    with open(input, "r") as f:
-        sequences = [
-            {
-                "id": record.id,
-                "seq": str(record.seq),
-                "number_informative_sites": informative_sites(str(record.seq)),
-            }
-            for record in itertools.islice(SeqIO.parse(f, "fasta"), 0, None)
-        ]
-    sequences = sorted(sequences, key=lambda x: x["number_informative_sites"], reverse=True)
-    composition = composition_per_site(sequences)
-    info_sites = informative_indexes_sorted_by_entropy(composition)
-
     # Divide work among processes - each process takes a batch of ying sequences
     num_sequences = len(sequences)
     batch_size = max(1, num_sequences // (num_processes * 5))  # Smaller batches for better load balancing
@@ -131,13 +656,132 @@ def deduplicate(input: str, output: str, num_processes: int = 10):
     pool.close()
     pool.join()
 
-    # Combine results
-    dup_list = {dup for batch_result in results for dup in batch_result}
+    # Combine results, keeping the earliest ying for each yang
+    representatives = {}
+    for yang_idx, ying_idx in sorted(itertools.chain.from_iterable(results)):
+        representatives.setdefault(yang_idx, ying_idx)
+    return representatives, num_sequences * (num_sequences - 1) // 2
+
+def deduplicate(
+    input: str,
+    output: str,
+    num_processes: int = 10,
+    engine: Engine = Engine.pairwise,
+    signature_sites: int = 32,
+    backend: Backend = Backend.python,
+    shared: Annotated[bool, typer.Option("--shared-memory")] = False,
+    state: Optional[str] = None,
+    fingerprint: Optional[List[str]] = None,
+    clusters: Optional[str] = None,
+):
+    """
+    Deduplicate sequences in a file
+    Args:
+        sequences: path to sequences file
+        output: path to output file
+        num_processes: number of cores to use (pairwise engine or shared memory only)
+        engine: pairwise compares all pairs, trie only compares pairs within signature buckets
+        signature_sites: number of highest entropy sites used as trie signature
+        backend: python keeps sequences as strings, numpy as one uint8 code matrix
+        shared: share the numpy code matrix with num_processes workers instead of running serially
+        state: path to a gzipped JSON cluster store; sequences already in it are not compared again
+        fingerprint: files the alignment depends on (mask, reference); the state is rebuilt if they change
+        clusters: path to a TSV mapping each removed sequence to the representative it is identical to
+    """
+    if shared and backend != Backend.numpy:
+        raise typer.BadParameter("--shared-memory requires --backend numpy")
+    if state and backend != Backend.numpy:
+        raise typer.BadParameter("--state requires --backend numpy")
+
+    if backend == Backend.numpy:
+        ids, matrix = read_alignment_matrix(input)
+        counts = composition_per_site_matrix(matrix)
+        info_sites = informative_indexes_sorted_by_entropy_matrix(counts, len(ids))
+        number_informative = informative_sites_matrix(matrix)
+        order = np.argsort(-number_informative, kind="stable")
+        ids = [ids[i] for i in order]
+        number_informative = number_informative[order]
+        if state:
+            hashes = content_hashes(matrix[order])
+            state_id = state_fingerprint(matrix.shape[1], fingerprint or [])
+        # Only keep the informative columns, already in entropy order
+        sites = matrix[np.ix_(order, info_sites)]
+        del matrix
+
+        if state:
+            representatives, neighbours, comparisons = find_duplicates_incremental(
+                ids, sites, hashes, load_state(state, state_id), signature_sites, num_processes, shared
+            )
+            save_state(state, state_id, ids, hashes, neighbours, representatives)
+        elif shared:
+            representatives, comparisons = find_duplicates_shared(
+                ids, sites, engine, signature_sites, num_processes
+            )
+        elif engine == Engine.trie:
+            representatives, comparisons = find_duplicates_trie_matrix(ids, sites, signature_sites)
+        else:
+            representatives, comparisons = find_duplicates_pairwise_matrix(ids, sites, num_processes)
+        print(f"Compared {comparisons} pairs of {len(ids)} sequences")
+
+        unknown = sites == WILDCARD_CODE
+        rows = [
+            (ids[ying_idx], ids[yang_idx], int(number_informative[yang_idx]),
+             int(np.count_nonzero(unknown[ying_idx] != unknown[yang_idx])))
+            for yang_idx, ying_idx in sorted(representatives.items())
+        ]
+        write_results(rows, output, clusters)
+        return
 
-    # Write output
+    with open(input, "r") as f:
+        sequences = [
+            {
+                "id": record.id,
+                "seq": str(record.seq),
+                "number_informative_sites": informative_sites(str(record.seq)),
+            }
+            for record in itertools.islice(SeqIO.parse(f, "fasta"), 0, None)
+        ]
+    sequences = sorted(sequences, key=lambda x: x["number_informative_sites"], reverse=True)
+    composition = composition_per_site(sequences)
+    info_sites = informative_indexes_sorted_by_entropy(composition)
+
+    if engine == Engine.trie:
+        representatives, comparisons = find_duplicates_trie(sequences, info_sites, signature_sites)
+    else:
+        representatives, comparisons = find_duplicates_pairwise(sequences, info_sites, num_processes)
+    print(f"Compared {comparisons} pairs of {len(sequences)} sequences")
+
+    rows = []
+    for yang_idx, ying_idx in sorted(representatives.items()):
+        ying_seq = sequences[ying_idx]
+        yang_seq = sequences[yang_idx]
+        rows.append((
+            ying_seq["id"], yang_seq["id"], yang_seq["number_informative_sites"],
+            sum(1 for i in info_sites if (ying_seq["seq"][i] in "ACGT") != (yang_seq["seq"][i] in "ACGT")),
+        ))
+    write_results(rows, output, clusters)
+
+def write_results(rows: list, output: str, clusters: Optional[str] = None, largest: int = 5):
+    """
+    Write the removed IDs, one per line, and optionally the cluster map
+    Each row is (representative, member, number of ACGT sites of the member,
+    number of informative sites where exactly one of the two is N)
+    Prints a summary instead of one line per removed sequence
+    """
     with open(output, "w") as f:
-        for dup in dup_list:
-            f.write(f"{dup}\n")
+        f.write("".join(f"{member}\n" for _, member, _, _ in rows))
+
+    if clusters:
+        with open(clusters, "w") as f:
+            f.write("representative\tmember\tnumber_informative_sites\tdiffering_n_sites\n")
+            f.write("".join("\t".join(map(str, row)) + "\n" for row in rows))
+
+    sizes = {}
+    for representative, _, _, _ in rows:
+        sizes[representative] = sizes.get(representative, 0) + 1
+    print(f"Removing {len(rows)} sequences as identical to one of {len(sizes)} representatives")
+    for representative, size in sorted(sizes.items(), key=lambda x: x[1], reverse=True)[:largest]:
+        print(f"  {representative}: {size} removed")
 
 if __name__ == "__main__":
     typer.run(deduplicate)
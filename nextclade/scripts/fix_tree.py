@@ -1,9 +1,74 @@
 import argparse
+import hashlib
+import json
+import os
+import tempfile
 from collections import defaultdict
+from io import StringIO
 
 from Bio import Phylo
+from Bio.Phylo.NewickIO import NewickError
 from treetime import TreeAnc
 
+# Bump when the reconstruction or the cache layout changes, to invalidate old cache entries
+CACHE_VERSION = "JC69-prune_short-1"
+
+def cache_key(input_tree, alignment, root):
+    """Hash of the input tree, the alignment and the root the reconstruction depends on"""
+    key = hashlib.sha256(CACHE_VERSION.encode())
+    for path in (input_tree, alignment):
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                key.update(block)
+        key.update(b"\0")
+    key.update(str(root).encode())
+    return key.hexdigest()
+
+
+def load_reconstruction(path, key):
+    """
+    Read a cached optimized tree, the mutations of each node in preorder and the length of one mutation
+    Returns None if the cache is for other inputs or cannot be read, so that it is treated as a miss
+    """
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+        if cached["key"] != key:
+            print(f"Cached ancestral reconstruction {path} is for another tree, alignment or root")
+            return None
+        T = Phylo.read(StringIO(cached["tree"]), "newick")
+        node_mutations = [[tuple(mut) for mut in mutations] for mutations in cached["mutations"]]
+        return T, node_mutations, cached["one_mutation"]
+    except (OSError, ValueError, KeyError, TypeError, NewickError) as e:
+        print(f"Ignoring unreadable cache {path}: {e}")
+        return None
+
+
+def save_reconstruction(path, key, T, node_mutations, one_mutation):
+    """
+    Write the optimized tree, the mutations of each node in preorder and the length of one mutation,
+    replacing the reconstruction for any previous inputs
+    """
+    tree = StringIO()
+    Phylo.write(T, tree, "newick", format_branch_length="%1.17g")
+    mutations = [[[str(mut[0]), int(mut[1]), str(mut[2])] for mut in muts] for muts in node_mutations]
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    # Write to a temporary file and move it into place, so that a killed job
+    # never leaves a truncated cache
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".json")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(
+                {"key": key, "tree": tree.getvalue(), "one_mutation": one_mutation, "mutations": mutations},
+                f,
+            )
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="remove time info",
@@ -14,25 +79,76 @@ if __name__ == "__main__":
     parser.add_argument("--input-tree", type=str, required=True, help="input nwk")
     parser.add_argument("--root", type=str, required=False, help="root node")
     parser.add_argument("--output", type=str, required=True, help="output nwk")
+    parser.add_argument(
+        "--cache",
+        type=str,
+        required=False,
+        help="JSON file to cache the ancestral reconstruction in, reused while input tree, alignment and root are unchanged",
+    )
     args = parser.parse_args()
 
-    T = Phylo.read(args.input_tree, "newick")
+    cached = None
+    if args.cache:
+        key = cache_key(args.input_tree, args.alignment, args.root)
+        if os.path.exists(args.cache):
+            cached = load_reconstruction(args.cache, key)
 
-    if args.root:
-        T.root_with_outgroup(args.root)
+    if cached is not None:
+        print(f"Using cached ancestral reconstruction {args.cache}")
+        T, node_mutations, one_mutation = cached
     else:
-        T.root_at_midpoint()
+        T = Phylo.read(args.input_tree, "newick")
+
+        if args.root:
+            T.root_with_outgroup(args.root)
+        else:
+            T.root_at_midpoint()
 
-    tt = TreeAnc(tree=T, aln=args.alignment, gtr="JC69")
-    tt.optimize_tree(prune_short=True)
+        tt = TreeAnc(tree=T, aln=args.alignment, gtr="JC69")
+        tt.optimize_tree(prune_short=True)
+        one_mutation = tt.one_mutation
+        node_mutations = [n.mutations for n in T.find_clades()]
+        if args.cache:
+            save_reconstruction(args.cache, key, T, node_mutations, one_mutation)
 
     # make list of mutations that are phylogenetically informative (not gaps of N)
-    for n in T.find_clades():
+    for n, mutations in zip(T.find_clades(), node_mutations):
         n.relevant_mutations = set()
-        for mut in n.mutations:
+        for mut in mutations:
             if (mut[0] in "ACGT") and (mut[2] in "ACGT"):
                 n.relevant_mutations.add(mut)
 
+    def index_by_position(mutations):
+        """Map each position to the tuple of mutations at it, keeping iteration order"""
+        index = defaultdict(tuple)
+        for mut in mutations:
+            index[mut[1]] += (mut,)
+        return index
+
+    def find_reversions(child, grandchild):
+        """Pairs of child mutations and grandchild mutations at the same position that revert them"""
+        grandchild_index = index_by_position(grandchild.relevant_mutations)
+        return [
+            (mut_child, mut_grandchild)
+            for mut_child in child.relevant_mutations
+            for mut_grandchild in grandchild_index.get(mut_child[1], ())
+            if mut_child[2] == mut_grandchild[0]
+        ]
+
+    def find_shared_mutations(node):
+        """Groups of children of node that share mutations, as (children, mutations) pairs"""
+        shared_mutations = defaultdict(list)
+        for c in node:
+            for mut in c.relevant_mutations:
+                shared_mutations[mut].append(c)
+
+        # For each mutation, if it occurs in more than one child, group it by the children that share it
+        groups = defaultdict(list)
+        for mut in shared_mutations:
+            if len(shared_mutations[mut]) > 1:
+                groups[tuple(shared_mutations[mut])].append(mut)
+        return list(groups.items())
+
     print("### Checking for immediate reversions\n")
     reversions = list()
     for clade in T.find_clades():
@@ -43,19 +159,17 @@ if __name__ == "__main__":
                 if grandchild.is_terminal():
                     continue
                 # Check if one of grandchild mutation reverts one of child
-                for mut_child in child.relevant_mutations:
-                    for mut_grandchild in grandchild.relevant_mutations:
-                        if mut_child[1] == mut_grandchild[1] and mut_child[2] == mut_grandchild[0]:
-                            reversions.append(
-                                {
-                                    "parent": clade,
-                                    "child": child,
-                                    "grandchild": grandchild,
-                                    "mut_child": mut_child,
-                                    "mut_grandchild": mut_grandchild,
-                                }
-                            )
-                            print(f"Below {clade}: {mut_child} in {child.name} reverted in {grandchild.name}")
+                for mut_child, mut_grandchild in find_reversions(child, grandchild):
+                    reversions.append(
+                        {
+                            "parent": clade,
+                            "child": child,
+                            "grandchild": grandchild,
+                            "mut_child": mut_child,
+                            "mut_grandchild": mut_grandchild,
+                        }
+                    )
+                    print(f"Below {clade}: {mut_child} in {child.name} reverted in {grandchild.name}")
 
     for reversion in reversions:
         # Remove reversion from grandchild
@@ -71,22 +185,24 @@ if __name__ == "__main__":
 
     # find mutations that occur multiple times in branches leading to children of a node.
     # use these mutations to group clades to merge later.
+    # Shared mutations are cached per node and only recomputed for nodes whose children changed
+    homoplasy_cache = {}
+    changed_nodes = set()
     max_iter = 5
     for ii in range(max_iter):
         print(f"###\nIteration: {ii+1}\n")
         nodes_to_merge = defaultdict(list)
 
         # For each node, for each mutation, find all children that have this mutation
-        for n in T.get_nonterminals():
-            shared_mutations = defaultdict(list)
-            for c in n:
-                for mut in c.relevant_mutations:
-                    shared_mutations[mut].append(c)
-
-            # For each mutation, if it occurs in more than one child, add the node and the children to the list of nodes to merge
-            for mut in shared_mutations:
-                if len(shared_mutations[mut]) > 1:
-                    nodes_to_merge[(n, tuple(shared_mutations[mut]))].append(mut)
+        nonterminals = T.get_nonterminals()
+        homoplasy_cache = {
+            n: homoplasy_cache[n] if n in homoplasy_cache and n not in changed_nodes else find_shared_mutations(n)
+            for n in nonterminals
+        }
+        changed_nodes = set()
+        for n in nonterminals:
+            for children, mutations in homoplasy_cache[n]:
+                nodes_to_merge[(n, children)].extend(mutations)
 
         if len(nodes_to_merge) == 0:
             print("No more shared mutations -- breaking out of loop.")
@@ -119,7 +235,7 @@ if __name__ == "__main__":
 
             # Create new internal node for the merged children
             new_clade = Phylo.BaseTree.Clade(
-                branch_length=tt.one_mutation * len(mutations),
+                branch_length=one_mutation * len(mutations),
                 name=f"{'_'.join([c.name for c in children])}_merged",
             )
             new_clade.relevant_mutations = set(mutations)
@@ -131,7 +247,7 @@ if __name__ == "__main__":
                 # Terminal nodes and internal nodes with mutations should be added as children to the new internal node
                 if len(left_over_mutations) or c.is_terminal():
                     c.relevant_mutations = left_over_mutations
-                    c.branch_length = tt.one_mutation * len(c.relevant_mutations)
+                    c.branch_length = one_mutation * len(c.relevant_mutations)
                     new_clade.clades.append(c)
                 # Internal branches of 0 length should be removed and children added to the new internal node directly
                 else:
@@ -139,6 +255,7 @@ if __name__ == "__main__":
                 already_touched.add(c)
 
             parent.clades.append(new_clade)
+            changed_nodes.update([parent, new_clade])
 
     # Prune all terminals without names
     count = 0
@@ -3,6 +3,8 @@ import csv
 import re
 import sys
 
+from accession_index import open_accession_index
+
 
 def load_accession_map(metadata_file):
     """
@@ -11,11 +13,15 @@ def load_accession_map(metadata_file):
     accession_map = {}
 
     with open(metadata_file, 'r', newline='') as tsv_file:
-        reader = csv.DictReader(tsv_file, delimiter='\t')
+        reader = csv.reader(tsv_file, delimiter='\t')
+        header = next(reader, [])
+        # Only the three accession columns are extracted from each row
+        columns = [header.index(c) if c in header else None
+                   for c in ('accession', 'insdcAccessionBase', 'insdcAccessionFull')]
         for row in reader:
-            ppx_accession = row.get('accession')
-            genbank_base = row.get('insdcAccessionBase')
-            genbank_full = row.get('insdcAccessionFull')
+            ppx_accession, genbank_base, genbank_full = (
+                row[i] if i is not None and i < len(row) else None for i in columns
+            )
 
             # Map both forms of GenBank accessions to PPX
             if genbank_base and ppx_accession:
@@ -25,20 +31,65 @@ def load_accession_map(metadata_file):
 
     return accession_map
 
-def replace_accessions_inplace(input_file, accession_map):
+class AccessionMatcher:
+    """
+    Find GenBank accessions of the mapping in a line with the same result as a regex
+    alternation of all accessions sorted longest first (leftmost match, longest accession
+    at that position, non-overlapping), but with dictionary lookups of the substrings
+    that start with a possible first character and have a possible accession length,
+    so that the cost does not grow with the number of accessions.
+    """
+
+    def __init__(self, accession_map):
+        self.accession_map = accession_map
+        lengths = set()
+        first_characters = set()
+        for accession in accession_map.keys():
+            lengths.add(len(accession))
+            first_characters.add(accession[0])
+        self.lengths = sorted(lengths, reverse=True)
+        self.starts = None
+        if first_characters:
+            self.starts = re.compile('[' + ''.join(re.escape(c) for c in sorted(first_characters)) + ']')
+
+    def findall(self, line):
+        """Return (start, end, accession) of all matches in the line."""
+        matches = []
+        if self.starts is None:
+            return matches
+        pos = 0
+        while True:
+            start = self.starts.search(line, pos)
+            if start is None:
+                return matches
+            pos = start.start()
+            for length in self.lengths:
+                candidate = line[pos:pos + length]
+                if len(candidate) == length and candidate in self.accession_map:
+                    matches.append((pos, pos + length, candidate))
+                    pos += length
+                    break
+            else:
+                pos += 1
+
+    def replace(self, line, matches):
+        """Rewrite all matches of the line to PPX accessions in one pass."""
+        parts = []
+        pos = 0
+        for start, end, accession in matches:
+            parts.append(line[pos:start])
+            parts.append(self.accession_map[accession])
+            pos = end
+        parts.append(line[pos:])
+        return ''.join(parts)
+
+
+def replace_accessions_inplace(input_file, matcher):
     """
     Process file line by line:
     - Keep original lines
     - Add new lines with replacements when GenBank accessions are found
     """
-    # Sort accessions by length (longest first) to avoid partial replacements
-    sorted_accessions = sorted(accession_map.keys(), key=len, reverse=True)
-
-    # Compile regex pattern for faster matching
-    # This creates a pattern like: (acc1|acc2|acc3) with proper escaping
-    pattern = '|'.join(re.escape(acc) for acc in sorted_accessions)
-    regex = re.compile(f'({pattern})')
-
     with open(input_file, 'r') as f:
         lines = f.readlines()
 
@@ -50,15 +101,16 @@ def replace_accessions_inplace(input_file, accession_map):
         new_lines.append(line)
 
         # Check if line contains any accessions
-        matches = regex.findall(line)
+        matches = matcher.findall(line)
         if matches:
             # Create a new line with replacements
-            modified_line = line
-            replacements_in_line = 0
+            modified_line = matcher.replace(line, matches)
 
-            for match in set(matches):  # Use set to avoid counting duplicates multiple times
-                modified_line = modified_line.replace(match, accession_map[match])
-                replacements_in_line += modified_line.count(accession_map[match])
+            # Use set to avoid counting duplicates multiple times
+            replacements_in_line = sum(
+                modified_line.count(matcher.accession_map[accession])
+                for accession in {accession for _, _, accession in matches}
+            )
 
             # If we made replacements, add the modified line
             if modified_line != line:
@@ -77,13 +129,25 @@ def main():
     parser = argparse.ArgumentParser(description='Process GenBank accessions to PPX accessions')
     parser.add_argument('--metadata', required=True, help='Path to the metadata.tsv file')
     parser.add_argument('--input', required=True, nargs='+', help='Input file(s) containing GenBank accessions')
+    parser.add_argument('--index',
+                        help='Persistent accession index (SQLite), built from the metadata when missing or out of date')
 
     args = parser.parse_args()
 
     # Load the accession mapping
     print(f"Loading accession mapping from {args.metadata}...", file=sys.stderr)
-    accession_map = load_accession_map(args.metadata)
+    if args.index:
+        index, rebuilt = open_accession_index(
+            args.index, args.metadata,
+            description="gb-to-ppx:accession:insdcAccessionBase:insdcAccessionFull",
+            load=lambda: (load_accession_map(args.metadata), ()),
+        )
+        print(f"{'Built' if rebuilt else 'Using'} accession index {args.index}", file=sys.stderr)
+        accession_map = index.mapping
+    else:
+        accession_map = load_accession_map(args.metadata)
     print(f"Loaded {len(accession_map)} accession mappings", file=sys.stderr)
+    matcher = AccessionMatcher(accession_map)
 
     # Process each input file
     total_files = len(args.input)
@@ -93,7 +157,7 @@ def main():
 
     for idx, input_file in enumerate(args.input, 1):
         print(f"Processing file {idx}/{total_files}: {input_file}...", file=sys.stderr)
-        replacements, lines_modified = replace_accessions_inplace(input_file, accession_map)
+        replacements, lines_modified = replace_accessions_inplace(input_file, matcher)
 
         if replacements > 0:
             changed_files += 1
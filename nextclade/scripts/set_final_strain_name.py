@@ -2,14 +2,89 @@ import pandas as pd
 import json
 import argparse
 
+from json_stream import JSONStreamReader
 
-def replace_name_recursive(node, lookup):
-    if node["name"] in lookup:
-        node["name"] = lookup[node["name"]]
 
-    if "children" in node:
-        for child in node["children"]:
-            replace_name_recursive(child, lookup)
+def read_name_lookup(metadata_file, display_strain_name):
+    """Map strain -> display name, falling back to the field name where it is missing"""
+    metadata = pd.read_csv(
+        metadata_file,
+        sep="\t",
+        usecols=list(dict.fromkeys(["strain", display_strain_name])),
+    )
+    display_names = metadata[display_strain_name].astype(object)
+    display_names = display_names.where(display_names.notna(), display_strain_name)
+    return dict(zip(metadata["strain"].tolist(), display_names.tolist()))
+
+
+def rewrite_names(input_fh, output_fh, lookup):
+    """
+    Stream an Auspice JSON from `input_fh` to `output_fh`, replacing the names of tree
+    nodes found in `lookup`. The tree is walked with an explicit stack of open nodes
+    and lists of children, so it can be of any depth, and only the current path through
+    it is kept in memory. Everything else is decoded one value at a time. The output is
+    formatted like `json.dump`.
+    """
+    reader = JSONStreamReader(input_fh)
+    out = []
+
+    def write_value():
+        out.append(json.dumps(reader.decode_value()))
+
+    # Open nodes and lists of nodes as [closing character, keys or indices, any entries written]
+    stack = []
+
+    def open_tree():
+        # A node, a list of nodes or, if malformed, anything else
+        char = reader.next_char()
+        if char == "{":
+            out.append("{")
+            stack.append(["}", reader.members(), False])
+        elif char == "[":
+            out.append("[")
+            stack.append(["]", reader.items(), False])
+        else:
+            write_value()
+
+    out.append("{")
+    for index, key in enumerate(reader.members()):
+        if index:
+            out.append(", ")
+        out.append(json.dumps(key) + ": ")
+        if key != "tree":
+            write_value()
+            continue
+
+        open_tree()
+        while stack:
+            entry = stack[-1]
+            key = next(entry[1], None)
+            if key is None:
+                stack.pop()
+                out.append(entry[0])
+                continue
+            if entry[2]:
+                out.append(", ")
+            entry[2] = True
+
+            if entry[0] == "]":
+                open_tree()
+            else:
+                out.append(json.dumps(key) + ": ")
+                if key == "children":
+                    open_tree()
+                elif key == "name":
+                    name = reader.decode_value()
+                    out.append(json.dumps(lookup.get(name, name)))
+                else:
+                    write_value()
+
+            if len(out) >= 10000:
+                output_fh.write("".join(out))
+                out.clear()
+    out.append("}")
+    reader.end()
+    output_fh.write("".join(out))
 
 
 if __name__ == "__main__":
@@ -29,20 +104,7 @@ if __name__ == "__main__":
     parser.add_argument("--output", type=str, metavar="JSON", required=True, help="output Auspice JSON")
     args = parser.parse_args()
 
-    metadata = pd.read_csv(args.metadata, sep="\t")
-    name_lookup = {}
-    for ri, row in metadata.iterrows():
-        strain_id = row["strain"]
-        name_lookup[strain_id] = (
-            args.display_strain_name
-            if pd.isna(row[args.display_strain_name])
-            else row[args.display_strain_name]
-        )
-
-    with open(args.input_auspice_json, "r") as fh:
-        data = json.load(fh)
-
-    replace_name_recursive(data["tree"], name_lookup)
+    name_lookup = read_name_lookup(args.metadata, args.display_strain_name)
 
-    with open(args.output, "w") as fh:
-        json.dump(data, fh)
+    with open(args.input_auspice_json, "r") as input_fh, open(args.output, "w") as output_fh:
+        rewrite_names(input_fh, output_fh, name_lookup)
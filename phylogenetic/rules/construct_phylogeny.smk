@@ -58,6 +58,9 @@ rule fix_tree:
             if config.get("treefix_root", False)
             else ""
         ),
+        # Reused across reruns with the same tree, alignment and root, and
+        # overwritten when they change, so only the latest reconstruction is kept
+        cache=lambda w: f"{build_dir}/{w.build_name}/fix_tree_cache.json",
     log:
         "logs/{build_name}/fix_tree.txt",
     benchmark:
@@ -70,6 +73,7 @@ rule fix_tree:
             --alignment {input.alignment:q} \
             --input-tree {input.tree:q} \
             {params.root} \
+            --cache {params.cache:q} \
             --output {output.tree:q}
         """
 
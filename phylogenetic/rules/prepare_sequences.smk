@@ -24,6 +24,12 @@ rule map_accessions:
     INSDC accessions (versioned or unversioned) are transformed to PPX accessions.
     PPX accessions pass through unchanged. This allows exclude/include files to
     contain a mixture of INSDC and PPX accessions.
+    The accession mapping is kept in an on-disk index that is rebuilt only when
+    results/metadata.tsv changes and is shared between builds.
+
+    The index is a persistent cache rather than an output: it is not tracked by
+    Snakemake, is validated against the metadata by the script on every run and
+    is replaced atomically, so it can be deleted at any time.
     """
     input:
         accession_list=lambda w: config[w.in_ex_clude],
@@ -31,6 +37,9 @@ rule map_accessions:
         script="scripts/map_accessions.py",
     output:
         accession_list=build_dir + "/{build_name}/{in_ex_clude}_ppx.txt",
+    params:
+        # Persistent cache shared between builds, see the docstring
+        index="results/accession_index.sqlite",
     wildcard_constraints:
         in_ex_clude="(include|exclude)",
     log:
@@ -44,6 +53,7 @@ rule map_accessions:
         {input.script:q} \
             --input {input.accession_list:q} \
             --metadata {input.metadata:q} \
+            --index {params.index:q} \
             --output {output.accession_list:q}
         """
 
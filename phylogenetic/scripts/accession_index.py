@@ -0,0 +1,126 @@
+"""
+Persistent on-disk index of accession mappings derived from a metadata TSV.
+
+The index is a SQLite database with a key -> accession mapping table and a table of
+all known accessions, both stored as B-trees so that lookups do not require loading
+the metadata. It records the size and modification time of the metadata file it was
+built from together with a description of how it was built, and is only rebuilt when
+either changes.
+
+This module is kept identical in phylogenetic/scripts/accession_index.py and
+nextclade/scripts/accession_index.py; change both copies together.
+"""
+
+import os
+import sqlite3
+import tempfile
+
+
+INDEX_VERSION = 1
+
+
+class IndexTable:
+    """Read-only dict/set-like view of one table of the index."""
+
+    def __init__(self, connection, table):
+        self.connection = connection
+        self.table = table
+
+    def get(self, key, default=None):
+        row = self.connection.execute(
+            f"SELECT value FROM {self.table} WHERE key = ?", (key,)
+        ).fetchone()
+        return default if row is None else row[0]
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.connection.execute(
+            f"SELECT 1 FROM {self.table} WHERE key = ?", (key,)
+        ).fetchone() is not None
+
+    def __iter__(self):
+        for (key,) in self.connection.execute(f"SELECT key FROM {self.table}"):
+            yield key
+
+    def keys(self):
+        return iter(self)
+
+    def __len__(self):
+        return self.connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+
+class AccessionIndex:
+    """
+    Open index with `mapping` (key -> accession) and `accessions` (known accessions)
+    tables.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        self.mapping = IndexTable(self.connection, "mapping")
+        self.accessions = IndexTable(self.connection, "accessions")
+
+
+def metadata_fingerprint(metadata_path, description):
+    """Identify a version of the metadata file and the way the index was derived from it."""
+    stat = os.stat(metadata_path)
+    return f"{INDEX_VERSION}:{stat.st_size}:{stat.st_mtime_ns}:{description}"
+
+
+def stored_fingerprint(index_path):
+    """Fingerprint stored in an existing index, or None if there is no usable index."""
+    if not os.path.exists(index_path):
+        return None
+    connection = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+    try:
+        row = connection.execute("SELECT value FROM info WHERE key = 'fingerprint'").fetchone()
+    except sqlite3.DatabaseError:
+        return None
+    finally:
+        connection.close()
+    return row[0] if row else None
+
+
+def write_index(index_path, mapping, accessions, fingerprint):
+    """
+    Write a new index to a temporary file and move it into place, so that concurrent
+    readers never see a partially written index.
+    """
+    directory = os.path.dirname(os.path.abspath(index_path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".sqlite")
+    os.close(fd)
+    try:
+        with sqlite3.connect(tmp_path) as connection:
+            connection.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID")
+            connection.execute("CREATE TABLE mapping (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID")
+            connection.execute("CREATE TABLE accessions (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID")
+            connection.executemany("INSERT INTO mapping VALUES (?, ?)", mapping.items())
+            connection.executemany("INSERT INTO accessions VALUES (?, ?)", ((a, a) for a in accessions))
+            connection.execute("INSERT INTO info VALUES ('fingerprint', ?)", (fingerprint,))
+        connection.close()
+        os.replace(tmp_path, index_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def open_accession_index(index_path, metadata_path, description, load):
+    """
+    Open the index at `index_path`, first (re)building it with `load()` if it does not
+    exist or was built from a different version of `metadata_path` or with a different
+    `description`. `load` returns a (mapping dict, set of accessions) tuple.
+
+    Returns the open index and whether it was rebuilt.
+    """
+    fingerprint = metadata_fingerprint(metadata_path, description)
+    rebuilt = stored_fingerprint(index_path) != fingerprint
+    if rebuilt:
+        mapping, accessions = load()
+        write_index(index_path, mapping, accessions, fingerprint)
+    return AccessionIndex(index_path), rebuilt
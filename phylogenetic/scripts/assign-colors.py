@@ -38,16 +38,21 @@ if __name__ == '__main__':
     # 1. remove assignments that don't exist in metadata
     # 2. remove assignments that have 'focal' set to 'False' in metadata
     if args.metadata:
-        metadata = pd.read_csv(args.metadata, delimiter='\t')
-        for name, trait in assignment.items():
+        # Only read the ordered traits and 'focal'
+        columns = pd.read_csv(args.metadata, delimiter='\t', nrows=0).columns
+        usecols = [name for name in [*assignment, 'focal'] if name in columns]
+        metadata = pd.read_csv(args.metadata, delimiter='\t', usecols=usecols)
+        focal_metadata = metadata.loc[metadata['focal'] == True] if 'focal' in metadata else None
+        for name in assignment:
+            if name not in metadata:
+                continue
             # Items not to exclude if not (yet) present in metadata to solve bootstrapping issue
-            if name in metadata and name not in ['clade_membership', 'outbreak', 'lineage']:
-                subset_present = [x for x in assignment[name] if x in metadata[name].unique()]
-                assignment[name] = subset_present
-            if name in metadata and 'focal' in metadata:
-                focal_list = metadata.loc[metadata['focal'] == True, name].unique()
-                subset_focal = [x for x in assignment[name] if x in focal_list]
-                assignment[name] = subset_focal
+            if name not in ['clade_membership', 'outbreak', 'lineage']:
+                present = set(metadata[name].unique())
+                assignment[name] = [x for x in assignment[name] if x in present]
+            if focal_metadata is not None:
+                focal = set(focal_metadata[name].unique())
+                assignment[name] = [x for x in assignment[name] if x in focal]
 
     schemes = {}
     counter = 0
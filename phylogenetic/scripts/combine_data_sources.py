@@ -1,16 +1,18 @@
 # TODO: with the release of `augur merge` this script should be replaced
 # (it was written prior to `augur merge` existing, however it should be a drop-in replacement)
 
-from typing import Any
-from Bio import SeqIO
+from collections import Counter
+from typing import Any, Iterator, Optional
 import argparse
 import csv
 
-Sequences = dict[str, SeqIO.SeqRecord]
-Metadata = list[dict[str, Any]]
+# Sequence name -> (index of the FASTA file, offset of the sequence after its header line)
+SequenceIndex = dict[str, tuple[int, int]]
+MetadataRow = dict[str, Any]
 MetadataHeader = list[str]
 
 ACCESSION = 'accession'
+FASTA_LINE_WIDTH = 60
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -25,42 +27,100 @@ def parse_args():
     parser.add_argument('--output-sequences', type=str, required=True, help="output sequences")
     return parser.parse_args()
 
-def parse_tsv(fname: str) -> Metadata:
+def parse_source(arg: str) -> tuple[Optional[str], str]:
     source_name = None
-    assert list(fname).count('=')<=1, f"Too many '=' characters in argument {fname!r}"
-    if '=' in fname:
-        source_name, fname = fname.split('=')
+    fname = arg
+    assert list(arg).count('=')<=1, f"Too many '=' characters in argument {arg!r}"
+    if '=' in arg:
+        source_name, fname = arg.split('=')
+    return source_name, fname
+
+def source_column(source_name: Optional[str]) -> Optional[str]:
+    return f"source_{source_name}" if source_name else None
+
+def read_header(source_name: Optional[str], fname: str) -> MetadataHeader:
+    with open(fname, "r", newline='') as fh:
+        header = list(csv.DictReader(fh, delimiter="\t").fieldnames or [])
+    source_col = source_column(source_name)
+    if source_col and source_col not in header:
+        header.append(source_col)
+    return header
+
+def read_rows(source_name: Optional[str], fname: str) -> Iterator[MetadataRow]:
+    """Stream the rows of a metadata file, with the 'source_{name}' one-hot column added"""
+    source_col = source_column(source_name)
     with open(fname, "r", newline='') as fh:
-        reader = csv.DictReader(fh, delimiter="\t")
-        metadata = [row for row in reader]
-    if source_name:
-        for row in metadata:
-            row[f"source_{source_name}"] = 'true'
-    return metadata
-
-def parse_sequences(fnames: list[str]) -> tuple[Sequences, set[str]]:
-    sequences = {}
-    for fname in fnames:
-        for seq_record in SeqIO.parse(fname, "fasta"):
-            name = seq_record.id
-            seq_record.id = name
-            seq_record.description = seq_record.id
-            if name in sequences:
-                print(f"WARNING: the sequence {name!r} (from {fname!r}) has already been seen! Overwriting...")
-            sequences[name] = seq_record
-    return sequences, set(list(sequences.keys()))
-
-def merge_meta(data: list[Metadata], id_col:str) -> tuple[Metadata, MetadataHeader]:
-    header: MetadataHeader = list(data[0][0].keys()) # first metadata file...
-    for metadata in data[1:]:
-        for col_name in list(metadata[0].keys()):
+        for row in csv.DictReader(fh, delimiter="\t"):
+            if source_col:
+                row[source_col] = 'true'
+            yield row
+
+def index_sequences(fnames: list[str]) -> SequenceIndex:
+    """
+    Scan the FASTA files for sequence names and the offsets of their sequences.
+    The last occurrence of a name is used, at the position of its first occurrence.
+    """
+    index: SequenceIndex = {}
+    for file_idx, fname in enumerate(fnames):
+        with open(fname, "rb") as fh:
+            offset = 0
+            for line in fh:
+                offset += len(line)
+                if line[:1] != b">":
+                    continue
+                title = line[1:].decode().split(None, 1)
+                name = title[0] if title else ""
+                if name in index:
+                    print(f"WARNING: the sequence {name!r} (from {fname!r}) has already been seen! Overwriting...")
+                index[name] = (file_idx, offset)
+    return index
+
+def read_sequence(fh) -> bytes:
+    sequence = []
+    for line in fh:
+        if line[:1] == b">":
+            break
+        sequence.append(line)
+    return b"".join(sequence).translate(None, b" \t\r\n")
+
+def write_sequences(fname: str, fnames: list[str], index: SequenceIndex) -> None:
+    """Stream the sequences in `index` from their source files, wrapped like `SeqIO.write`"""
+    print(f"Writing sequences to {fname}")
+    handles = [open(source, "rb") for source in fnames]
+    try:
+        with open(fname, "wb") as out:
+            for name, (file_idx, offset) in index.items():
+                fh = handles[file_idx]
+                fh.seek(offset)
+                sequence = read_sequence(fh)
+                out.write(b">" + name.encode() + b"\n")
+                for i in range(0, len(sequence), FASTA_LINE_WIDTH):
+                    out.write(sequence[i:i + FASTA_LINE_WIDTH] + b"\n")
+    finally:
+        for fh in handles:
+            fh.close()
+
+def merge_meta(sources: list[tuple[Optional[str], str]], id_col: str) -> tuple[MetadataHeader, Counter, dict[str, MetadataRow]]:
+    """
+    Index the metadata by ID and merge the rows of IDs seen more than once, so that only
+    those rows are held in memory. Values are backfilled, in the case of conflicts the
+    last seen is used.
+    """
+    header: MetadataHeader = []
+    id_counts: Counter = Counter()
+    for source_name, fname in sources:
+        source_header = read_header(source_name, fname)
+        assert id_col in source_header, f"ERROR: metadata file missing {id_col!r}"
+        for col_name in source_header:
             if col_name not in header:
                 header.append(col_name)
+        id_counts.update(row[id_col] for row in read_rows(source_name, fname))
 
-    row_by_id: dict[str, dict[str, Any]] = {}
-    for metadata in data:
-        for row in metadata:
-            assert id_col in row, f"ERROR: metadata file missing {id_col!r}"
+    row_by_id: dict[str, MetadataRow] = {}
+    for source_name, fname in sources:
+        for row in read_rows(source_name, fname):
+            if id_counts[row[id_col]] < 2:
+                continue
             if row[id_col] in row_by_id:
                 print(f"Multiple entries for {row[id_col]} - merging!")
                 master_row = row_by_id[row[id_col]]
@@ -69,24 +129,28 @@ def merge_meta(data: list[Metadata], id_col:str) -> tuple[Metadata, MetadataHead
             else:
                 row_by_id[row[id_col]] = row
 
-    return list(row_by_id.values()), header
-
-def write_sequences(fname: str, sequences: Sequences) -> None:
-    print(f"Writing sequences to {fname}")
-    SeqIO.write([x for x in sequences.values()], fname, "fasta")
+    return header, id_counts, row_by_id
 
-def write_metadata(fname: str, metadata: Metadata, header: MetadataHeader) -> None:
+def write_metadata(fname: str, sources: list[tuple[Optional[str], str]], id_col: str,
+                   header: MetadataHeader, id_counts: Counter, merged_rows: dict[str, MetadataRow]) -> None:
+    """Stream the metadata rows in order of first appearance of their ID"""
     print(f"Writing metadata to {fname}")
     with open(fname, "w", newline='') as fh:
         writer = csv.DictWriter(fh, header, extrasaction='ignore', delimiter='\t', lineterminator='\n')
         writer.writeheader()
-        for row in metadata:
-            writer.writerow(row)
+        for source_name, source_fname in sources:
+            for row in read_rows(source_name, source_fname):
+                row_id = row[id_col]
+                if row_id in merged_rows:
+                    # Written at the first appearance of the ID only
+                    writer.writerow(merged_rows.pop(row_id))
+                elif id_counts[row_id] < 2:
+                    writer.writerow(row)
 
 if __name__=="__main__":
     args = parse_args()
-    metadatas = [parse_tsv(f) for f in args.metadata]
-    sequences, sequence_names = parse_sequences(args.sequences)
-    metadata, header = merge_meta(metadatas, args.metadata_id_column)
-    write_sequences(args.output_sequences, sequences)
-    write_metadata(args.output_metadata, metadata, header)
+    sources = [parse_source(f) for f in args.metadata]
+    sequence_index = index_sequences(args.sequences)
+    header, id_counts, merged_rows = merge_meta(sources, args.metadata_id_column)
+    write_sequences(args.output_sequences, args.sequences, sequence_index)
+    write_metadata(args.output_metadata, sources, args.metadata_id_column, header, id_counts, merged_rows)
@@ -1,35 +1,46 @@
 import argparse
-from datetime import datetime
+from datetime import date
 from augur.io import read_metadata
+from augur.io.metadata import DEFAULT_DELIMITERS, DEFAULT_ID_COLUMNS, Metadata
 import json
+import numpy as np
+import pandas as pd
 
 ## Script originally from https://github.com/nextstrain/ncov/blob/master/scripts/construct-recency-from-submission-date.py
 
-def get_recency(date_str, ref_date):
-    date_released = datetime.strptime(date_str, '%Y-%m-%d').toordinal()
-    ref_day = ref_date.toordinal()
-
-    delta_days = ref_day - date_released
-    if delta_days<=0:
-        return 'New'
-    elif delta_days<3:
-        return '1-2 days ago'
-    elif delta_days<8:
-        return '3-7 days ago'
-    elif delta_days<15:
-        return 'One week ago'
-    elif delta_days<31:
-        return 'One month ago'
-    elif delta_days < 121:
-        return '1-3 months ago'
-    elif delta_days < 365:
-        return '3-12 months ago'
-    elif delta_days < 365*4:
-        return '1-3 years ago'
-    elif delta_days < 365*16:
-        return '3-15 years ago'
-    elif delta_days>=31:
-        return 'Older than 15 years'
+DATE_COLUMN = 'date_released'
+
+# A delta of fewer than RECENCY_THRESHOLDS[i] days (and at least the previous
+# threshold) falls into RECENCY_LABELS[i]
+RECENCY_THRESHOLDS = np.array([1, 3, 8, 15, 31, 121, 365, 365*4, 365*16])
+RECENCY_LABELS = np.array([
+    'New',
+    '1-2 days ago',
+    '3-7 days ago',
+    'One week ago',
+    'One month ago',
+    '1-3 months ago',
+    '3-12 months ago',
+    '1-3 years ago',
+    '3-15 years ago',
+    'Older than 15 years',
+])
+
+def get_recency(dates_released, ref_date):
+    """Recency labels of a Series of YYYY-MM-DD dates relative to the date `ref_date`"""
+    days_released = pd.to_datetime(dates_released, format='%Y-%m-%d').values.astype('datetime64[D]')
+    delta_days = (np.datetime64(ref_date, 'D') - days_released).astype(np.int64)
+    return RECENCY_LABELS[np.searchsorted(RECENCY_THRESHOLDS, delta_days, side='right')]
+
+def write_node_data(fname, strains, recencies):
+    """Stream `{"nodes": {strain: {"recency": ...}}}` to `fname`, formatted like `json.dump`"""
+    with open(fname, 'wt') as fh:
+        fh.write('{"nodes": {')
+        for i, (strain, recency) in enumerate(zip(strains, recencies)):
+            if i:
+                fh.write(', ')
+            fh.write(f'{json.dumps(strain)}: {{"recency": {json.dumps(recency)}}}')
+        fh.write('}}')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -42,14 +53,17 @@ if __name__ == '__main__':
     parser.add_argument('--output', type=str, required=True, help="output json")
     args = parser.parse_args()
 
-    meta = read_metadata(args.metadata, id_columns=args.metadata_id_columns).to_dict(orient="index")
-
-    node_data = {'nodes':{}}
-    ref_date = datetime.now()
-
-    for strain, d in meta.items():
-        if 'date_released' in d and d['date_released'] and d['date_released'] != "undefined":
-            node_data['nodes'][strain] = {'recency': get_recency(d['date_released'], ref_date)}
+    # Only read the ID and release date columns
+    metadata_file = Metadata(args.metadata, DEFAULT_DELIMITERS, args.metadata_id_columns or DEFAULT_ID_COLUMNS)
+    if DATE_COLUMN in metadata_file.columns:
+        dates = read_metadata(
+            args.metadata,
+            columns=[metadata_file.id_column, DATE_COLUMN],
+            id_columns=[metadata_file.id_column],
+            dtype="string",
+        )[DATE_COLUMN]
+        dates = dates[(dates != "") & (dates != "undefined")]
+    else:
+        dates = pd.Series(dtype="string")
 
-    with open(args.output, 'wt') as fh:
-        json.dump(node_data, fh)
+    write_node_data(args.output, dates.index, get_recency(dates, date.today()))
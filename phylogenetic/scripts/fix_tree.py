@@ -1,7 +1,69 @@
 from collections import defaultdict
+from io import StringIO
 import argparse
+import hashlib
+import json
+import os
+import tempfile
 from treetime import TreeAnc
 from Bio import Phylo
+from Bio.Phylo.NewickIO import NewickError
+
+# Bump when the reconstruction or the cache layout changes, to invalidate old cache entries
+CACHE_VERSION = "JC69-prune_short-1"
+
+def cache_key(input_tree, alignment, root):
+    """Hash of the input tree, the alignment and the root the reconstruction depends on"""
+    key = hashlib.sha256(CACHE_VERSION.encode())
+    for path in (input_tree, alignment):
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                key.update(block)
+        key.update(b"\0")
+    key.update(str(root).encode())
+    return key.hexdigest()
+
+
+def load_reconstruction(path, key):
+    """
+    Read a cached optimized tree, the mutations of each node in preorder and the length of one mutation
+    Returns None if the cache is for other inputs or cannot be read, so that it is treated as a miss
+    """
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+        if cached["key"] != key:
+            print(f"Cached ancestral reconstruction {path} is for another tree, alignment or root")
+            return None
+        T = Phylo.read(StringIO(cached["tree"]), "newick")
+        node_mutations = [[tuple(mut) for mut in mutations] for mutations in cached["mutations"]]
+        return T, node_mutations, cached["one_mutation"]
+    except (OSError, ValueError, KeyError, TypeError, NewickError) as e:
+        print(f"Ignoring unreadable cache {path}: {e}")
+        return None
+
+
+def save_reconstruction(path, key, T, node_mutations, one_mutation):
+    """
+    Write the optimized tree, the mutations of each node in preorder and the length of one mutation,
+    replacing the reconstruction for any previous inputs
+    """
+    tree = StringIO()
+    Phylo.write(T, tree, "newick", format_branch_length="%1.17g")
+    mutations = [[[str(mut[0]), int(mut[1]), str(mut[2])] for mut in muts] for muts in node_mutations]
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    # Write to a temporary file and move it into place, so that a killed job
+    # never leaves a truncated cache
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".json")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({"key": key, "tree": tree.getvalue(), "one_mutation": one_mutation, "mutations": mutations}, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
 
 if __name__=="__main__":
     parser = argparse.ArgumentParser(
@@ -13,36 +75,95 @@ if __name__=="__main__":
     parser.add_argument('--input-tree', type=str, required=True, help="input nwk")
     parser.add_argument('--root', type=str, required=False, help="root node")
     parser.add_argument('--output', type=str, required=True, help="output nwk")
+    parser.add_argument('--cache', type=str, required=False, help="JSON file to cache the ancestral reconstruction in, reused while the input tree, alignment and root are unchanged")
     args = parser.parse_args()
 
-    T = Phylo.read(args.input_tree, 'newick')
+    cached = None
+    if args.cache:
+        key = cache_key(args.input_tree, args.alignment, args.root)
+        if os.path.exists(args.cache):
+            cached = load_reconstruction(args.cache, key)
 
-    if args.root:
-        T.root_with_outgroup(args.root)
+    if cached is not None:
+        print(f"Using cached ancestral reconstruction {args.cache}")
+        T, node_mutations, one_mutation = cached
     else:
-        T.root_at_midpoint()
+        T = Phylo.read(args.input_tree, 'newick')
+
+        if args.root:
+            T.root_with_outgroup(args.root)
+        else:
+            T.root_at_midpoint()
 
-    tt = TreeAnc(tree=T, aln=args.alignment, gtr='JC69')
-    tt.optimize_tree(prune_short=True)
+        tt = TreeAnc(tree=T, aln=args.alignment, gtr='JC69')
+        tt.optimize_tree(prune_short=True)
+        one_mutation = tt.one_mutation
+        node_mutations = [n.mutations for n in T.find_clades()]
+        if args.cache:
+            save_reconstruction(args.cache, key, T, node_mutations, one_mutation)
 
     # make list of mutations that are phylogenetically informative (not gaps of N)
-    for n in T.find_clades():
+    for n, mutations in zip(T.find_clades(), node_mutations):
         n.relevant_mutations = set()
-        for mut in n.mutations:
+        for mut in mutations:
             if (mut[0] in 'ACGT') and (mut[2] in 'ACGT'):
                 n.relevant_mutations.add(mut)
 
-    # Helper function to check if a node is a descendant of any node in a set
-    def is_descendant_of_any(node, ancestor_set, tree):
-        """Check if node is a descendant of any node in ancestor_set using tree paths"""
-        # Get the path from root to node
-        path = tree.get_path(node)
-        # Check if any ancestor is in the path
-        for ancestor in ancestor_set:
-            if ancestor in path:
+    # Helper functions to check if a node is a descendant of any node in a set
+    def build_parent_index(tree):
+        """Map each clade to its parent clade in one traversal of the tree"""
+        parents = {}
+        for clade in tree.find_clades(order="level"):
+            for child in clade.clades:
+                parents[child] = clade
+        return parents
+
+    def is_descendant_of_any(node, ancestor_set, parents):
+        """Check if node or any of its ancestors below the root is in ancestor_set, walking up the parent index"""
+        if not ancestor_set:
+            return False
+        # The root has no parent and, as in tree.get_path, never counts as an ancestor
+        while node in parents:
+            if node in ancestor_set:
                 return True
+            node = parents[node]
         return False
 
+    # Helper functions to find reversions and homoplasies through position-indexed mutations
+    def index_by_position(mutations):
+        """Map each position to the tuple of mutations at it, keeping iteration order"""
+        index = defaultdict(tuple)
+        for mut in mutations:
+            index[mut[1]] += (mut,)
+        return index
+
+    def find_reversions(child, grandchild):
+        """Pairs of child mutations and grandchild mutations at the same position that revert them"""
+        grandchild_index = index_by_position(grandchild.relevant_mutations)
+        return [
+            (mut_child, mut_grandchild)
+            for mut_child in child.relevant_mutations
+            for mut_grandchild in grandchild_index.get(mut_child[1], ())
+            if mut_child[2] == mut_grandchild[0]
+        ]
+
+    def find_shared_mutations(node):
+        """Groups of children of node that share mutations, as (children, mutations) pairs"""
+        shared_mutations = defaultdict(list)
+        for c in node:
+            for mut in c.relevant_mutations:
+                shared_mutations[mut].append(c)
+
+        groups = defaultdict(list)
+        for mut in shared_mutations:
+            if len(shared_mutations[mut])>1:
+                groups[tuple(shared_mutations[mut])].append(mut)
+        return list(groups.items())
+
+    # Shared mutations per internal node, only recomputed for nodes whose children changed
+    homoplasy_cache = {}
+    changed_nodes = set()
+
     # Main iteration loop: fix reversions and merge homoplasies until nothing changes
     max_iter = 5
     for ii in range(max_iter):
@@ -61,19 +182,17 @@ if __name__=="__main__":
                     if grandchild.is_terminal():
                         continue
                     # Check if one of grandchild mutation reverts one of child
-                    for mut_child in child.relevant_mutations:
-                        for mut_grandchild in grandchild.relevant_mutations:
-                            if mut_child[1] == mut_grandchild[1] and mut_child[2] == mut_grandchild[0]:
-                                reversions.append(
-                                    {
-                                        "parent": clade,
-                                        "child": child,
-                                        "grandchild": grandchild,
-                                        "mut_child": mut_child,
-                                        "mut_grandchild": mut_grandchild
-                                    }
-                                )
-                                print(f"  Below {clade.name}: {mut_child} in {child.name} reverted in {grandchild.name}")
+                    for mut_child, mut_grandchild in find_reversions(child, grandchild):
+                        reversions.append(
+                            {
+                                "parent": clade,
+                                "child": child,
+                                "grandchild": grandchild,
+                                "mut_child": mut_child,
+                                "mut_grandchild": mut_grandchild
+                            }
+                        )
+                        print(f"  Below {clade.name}: {mut_child} in {child.name} reverted in {grandchild.name}")
 
         if reversions:
             # Group reversions by unique (parent, child, grandchild) triple to avoid duplicate processing
@@ -84,6 +203,8 @@ if __name__=="__main__":
 
             # Track nodes that have been modified to avoid nested modifications within this iteration
             touched_nodes = set()
+            # Parent of each clade, kept up to date as grandchildren are moved below
+            parents = build_parent_index(T)
 
             # Process each unique (parent, child, grandchild) triple only once, greedily
             for key, rev_list in reversion_groups.items():
@@ -93,7 +214,7 @@ if __name__=="__main__":
                 grandchild = rev_list[0]["grandchild"]
 
                 # Skip if parent is a descendant of an already-touched node (avoid nested modifications)
-                if is_descendant_of_any(parent, touched_nodes, T):
+                if is_descendant_of_any(parent, touched_nodes, parents):
                     print(f"    Skipping reversion at {parent.name} (descendant of already-touched node)")
                     continue
 
@@ -109,12 +230,16 @@ if __name__=="__main__":
                 # Add grandchild to parent (only once)
                 if grandchild.relevant_mutations != parent.relevant_mutations:
                     parent.clades.append(grandchild)
+                    parents[grandchild] = parent
                 else:
                     # Otherwise add grandchild clades to parent
                     parent.clades.extend(grandchild.clades)
+                    for c in grandchild.clades:
+                        parents[c] = parent
 
                 # Mark parent as touched to prevent nested modifications
                 touched_nodes.add(parent)
+                changed_nodes.update([parent, child])
                 changes_made = True
 
             print(f"  Fixed {len(touched_nodes)} reversion groups")
@@ -122,15 +247,15 @@ if __name__=="__main__":
         # Step 2: Check for and merge homoplasies
         print(f"Checking for homoplasies...")
         nodes_to_merge = defaultdict(list)
-        for n in T.get_nonterminals():
-            shared_mutations = defaultdict(list)
-            for c in n:
-                for mut in c.relevant_mutations:
-                    shared_mutations[mut].append(c)
-
-            for mut in shared_mutations:
-                if len(shared_mutations[mut])>1:
-                    nodes_to_merge[(n,tuple(shared_mutations[mut]))].append(mut)
+        nonterminals = T.get_nonterminals()
+        homoplasy_cache = {
+            n: homoplasy_cache[n] if n in homoplasy_cache and n not in changed_nodes else find_shared_mutations(n)
+            for n in nonterminals
+        }
+        changed_nodes = set()
+        for n in nonterminals:
+            for children, mutations in homoplasy_cache[n]:
+                nodes_to_merge[(n,children)].extend(mutations)
 
         if nodes_to_merge:
             already_touched = set()
@@ -143,19 +268,20 @@ if __name__=="__main__":
                 print()
 
                 parent.clades = [c for c in parent if c not in children]
-                new_clade = Phylo.BaseTree.Clade(branch_length=tt.one_mutation*len(mutations))
+                new_clade = Phylo.BaseTree.Clade(branch_length=one_mutation*len(mutations))
                 new_clade.relevant_mutations = set(mutations)
                 for c in children:
                     left_over_mutations = c.relevant_mutations.difference(mutations)
                     if len(left_over_mutations):
                         c.relevant_mutations = left_over_mutations
-                        c.branch_length = tt.one_mutation*len(c.relevant_mutations)
+                        c.branch_length = one_mutation*len(c.relevant_mutations)
                         new_clade.clades.append(c)
                     else:
                         new_clade.clades.extend(c.clades)
                     already_touched.add(c)
 
                 parent.clades.append(new_clade)
+                changed_nodes.update([parent, new_clade])
                 changes_made = True
 
             print(f"  Merged {len(already_touched)} homoplasy groups")
@@ -0,0 +1,118 @@
+"""
+Incremental JSON reader for files too large or too deeply nested for `json.load`.
+
+The reader walks the structure of a JSON document one value at a time. The
+caller asks for the members of an object or the items of an array and decodes
+each value with `json.JSONDecoder.raw_decode`, or opens it in turn, so only
+the current value and a chunk of the file are held in memory and nesting does
+not need recursion. Separators are checked as the document is read, so
+malformed input raises a ValueError.
+
+This module is kept identical in phylogenetic/scripts and nextclade/scripts;
+change both copies together.
+"""
+import json
+import re
+
+CHUNK_SIZE = 1024 * 1024
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+VALUE_END = " \t\n\r,:]}"
+
+
+class JSONStreamReader:
+    def __init__(self, fh, chunk_size=CHUNK_SIZE):
+        self.fh = fh
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self):
+        chunk = self.fh.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+
+    def at_end(self):
+        """Skip whitespace and return whether the end of the input is reached"""
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return False
+            if self.eof:
+                return True
+            self.read_more()
+
+    def next_char(self):
+        """Skip whitespace and return the next character without consuming it"""
+        if self.at_end():
+            raise ValueError("Unexpected end of JSON")
+        return self.buffer[self.pos]
+
+    def expect(self, char):
+        if self.next_char() != char:
+            raise ValueError(f"Expected {char!r} in JSON at {self.buffer[self.pos : self.pos + 20]!r}")
+        self.pos += 1
+
+    def decode_value(self):
+        """Decode the value at the current position"""
+        self.next_char()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number may be cut off at the end of the buffer, so the value must be
+                # followed by a separator
+                if self.eof or (end < len(self.buffer) and self.buffer[end] in VALUE_END):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.read_more()
+
+    def members(self):
+        """
+        Yield the keys of the object at the current position, leaving the position
+        at each value, which the caller must consume before asking for the next key
+        """
+        self.expect("{")
+        if self.next_char() == "}":
+            self.pos += 1
+            return
+        while True:
+            if self.next_char() != '"':
+                raise ValueError(f"Expected a key in JSON at {self.buffer[self.pos : self.pos + 20]!r}")
+            key = self.decode_value()
+            self.expect(":")
+            yield key
+            if self.next_char() == ",":
+                self.pos += 1
+            else:
+                self.expect("}")
+                return
+
+    def items(self):
+        """
+        Yield the indices of the items of the array at the current position, leaving
+        the position at each item, which the caller must consume before asking for the next
+        """
+        self.expect("[")
+        if self.next_char() == "]":
+            self.pos += 1
+            return
+        index = 0
+        while True:
+            yield index
+            index += 1
+            if self.next_char() == ",":
+                self.pos += 1
+            else:
+                self.expect("]")
+                return
+
+    def end(self):
+        """Check that nothing but whitespace follows the document"""
+        if not self.at_end():
+            raise ValueError(f"Extra data after JSON at {self.buffer[self.pos : self.pos + 20]!r}")
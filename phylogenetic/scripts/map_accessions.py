@@ -6,6 +6,9 @@ This script reads an accession list file (exclude.txt or include.txt) that conta
 INSDC accessions and/or PPX accessions. INSDC accessions (versioned or unversioned)
 are transformed to PPX accessions by looking up the mapping in the metadata file.
 PPX accessions pass through unchanged. Comments and formatting are preserved.
+
+With --index, the mapping is kept in a persistent on-disk index that is built once
+per version of the metadata file and shared by all invocations.
 """
 
 import argparse
@@ -13,6 +16,8 @@ import pandas as pd
 import sys
 from pathlib import Path
 
+from accession_index import open_accession_index
+
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -49,26 +54,38 @@ def parse_args():
         action='store_true',
         help='Warn about accessions that cannot be mapped (default: silent)'
     )
+    parser.add_argument(
+        '--index',
+        help='Persistent accession index (SQLite) to build from the metadata if missing or '
+             'out of date and to look accessions up in (default: map in memory)'
+    )
     return parser.parse_args()
 
 
 def load_metadata(metadata_path, insdc_column, ppx_column):
     """Load metadata and create INSDC -> PPX mapping dictionary and PPX accession set."""
     try:
-        metadata = pd.read_csv(metadata_path, sep='\t', low_memory=False)
+        columns = pd.read_csv(metadata_path, sep='\t', nrows=0).columns
     except Exception as e:
         print(f"Error reading metadata file: {e}", file=sys.stderr)
         sys.exit(1)
 
     # Check required columns exist
-    if insdc_column not in metadata.columns:
+    if insdc_column not in columns:
         print(f"Error: Column '{insdc_column}' not found in metadata", file=sys.stderr)
-        print(f"Available columns: {', '.join(metadata.columns)}", file=sys.stderr)
+        print(f"Available columns: {', '.join(columns)}", file=sys.stderr)
         sys.exit(1)
 
-    if ppx_column not in metadata.columns:
+    if ppx_column not in columns:
         print(f"Error: Column '{ppx_column}' not found in metadata", file=sys.stderr)
-        print(f"Available columns: {', '.join(metadata.columns)}", file=sys.stderr)
+        print(f"Available columns: {', '.join(columns)}", file=sys.stderr)
+        sys.exit(1)
+
+    # Only the two accession columns are read
+    try:
+        metadata = pd.read_csv(metadata_path, sep='\t', usecols=[insdc_column, ppx_column], low_memory=False)
+    except Exception as e:
+        print(f"Error reading metadata file: {e}", file=sys.stderr)
         sys.exit(1)
 
     # Create mapping dictionary for INSDC -> PPX
@@ -76,10 +93,7 @@ def load_metadata(metadata_path, insdc_column, ppx_column):
     # Create set of valid PPX accessions
     valid_ppx = set()
 
-    for _, row in metadata.iterrows():
-        insdc = row[insdc_column]
-        ppx = row[ppx_column]
-
+    for insdc, ppx in zip(metadata[insdc_column], metadata[ppx_column]):
         # Skip rows where either value is NaN
         if pd.notna(ppx):
             ppx_str = str(ppx).strip()
@@ -155,8 +169,17 @@ def main():
     args = parse_args()
 
     # Load metadata and create mapping
-    print(f"Loading metadata from {args.metadata}...", file=sys.stderr)
-    insdc_to_ppx, valid_ppx = load_metadata(args.metadata, args.insdc_column, args.ppx_column)
+    if args.index:
+        index, rebuilt = open_accession_index(
+            args.index, args.metadata,
+            description=f"map_accessions:{args.insdc_column}:{args.ppx_column}",
+            load=lambda: load_metadata(args.metadata, args.insdc_column, args.ppx_column),
+        )
+        print(f"{'Built' if rebuilt else 'Using'} accession index {args.index}", file=sys.stderr)
+        insdc_to_ppx, valid_ppx = index.mapping, index.accessions
+    else:
+        print(f"Loading metadata from {args.metadata}...", file=sys.stderr)
+        insdc_to_ppx, valid_ppx = load_metadata(args.metadata, args.insdc_column, args.ppx_column)
     print(f"Loaded {len(insdc_to_ppx)} INSDC -> PPX accession mappings", file=sys.stderr)
     print(f"Found {len(valid_ppx)} valid PPX accessions", file=sys.stderr)
 
@@ -1,7 +1,115 @@
-from collections import defaultdict
 import json, argparse
+import numpy as np
+from Bio import Phylo
 
+from json_stream import JSONStreamReader
 
+NUCLEOTIDES = 'ACGT'
+# SBS-96 classes in the usual order: pyrimidine-centred substitution, then 5' base, then 3' base
+SUBSTITUTIONS = ['C>A', 'C>G', 'C>T', 'T>A', 'T>C', 'T>G']
+SBS96_CLASSES = [f"{five}[{sub}]{three}" for sub in SUBSTITUTIONS for five in NUCLEOTIDES for three in NUCLEOTIDES]
+
+# ASCII code -> 0..3 for ACGT, -1 for anything else
+NUC_CODE = np.full(256, -1, dtype=np.int8)
+for i, n in enumerate(NUCLEOTIDES):
+    NUC_CODE[ord(n)] = i
+# (ref, alt) -> substitution index for pyrimidine refs, with purine refs mapped onto their complement
+SUB_INDEX = np.full((4, 4), -1, dtype=np.int64)
+for i, sub in enumerate(SUBSTITUTIONS):
+    ref, alt = NUCLEOTIDES.index(sub[0]), NUCLEOTIDES.index(sub[2])
+    SUB_INDEX[ref, alt] = i
+    SUB_INDEX[3-ref, 3-alt] = i
+
+
+def stream_node_data(fh, key="nodes"):
+    """
+    Yield (name, node) pairs of one top-level object of a node-data JSON, one node at a time,
+    so that only a single node (and its sequence) is held in memory
+    """
+    reader = JSONStreamReader(fh)
+    for top_key in reader.members():
+        if top_key != key:
+            reader.decode_value()
+            continue
+        for name in reader.members():
+            yield name, reader.decode_value()
+    reader.end()
+
+
+def parse_mutations(muts):
+    """
+    Parse mutations like "G123A" once into integer arrays of reference base, 1-based position and
+    alternative base (bases coded 0..3 for ACGT, -1 otherwise)
+    """
+    ref = NUC_CODE[np.frombuffer(''.join(m[0] for m in muts).encode(), dtype=np.uint8)]
+    alt = NUC_CODE[np.frombuffer(''.join(m[-1] for m in muts).encode(), dtype=np.uint8)]
+    pos = np.fromiter((int(m[1:-1]) for m in muts), dtype=np.int64, count=len(muts))
+    return ref, pos, alt
+
+
+def node_context(node):
+    """
+    GA/CT fraction of the mutations on a node's branch, fraction of those in APOBEC3 dinucleotide context
+    and the SBS-96 trinucleotide spectrum of the branch (context taken from the node's sequence)
+    """
+    ref, pos, alt = parse_mutations(node["muts"])
+    sequence = np.frombuffer(node['sequence'].encode(), dtype=np.uint8)
+    acgt = (ref >= 0) & (alt >= 0)
+    GA = acgt & (ref == 2) & (alt == 0)
+    CT = acgt & (ref == 1) & (alt == 3)
+
+    total_muts = int(acgt.sum())
+    GA_CT_count = int(GA.sum() + CT.sum())
+    if total_muts:
+        context = {"GA_CT_fraction": GA_CT_count/total_muts}
+    else:
+        context = {"GA_CT_fraction": None }
+
+    if GA_CT_count:
+        dinuc_count = int((sequence[pos[GA]] == ord('A')).sum() + (sequence[pos[CT]-2] == ord('T')).sum())
+        context["dinuc_context_fraction"] = dinuc_count/GA_CT_count
+    else:
+        context["dinuc_context_fraction"] = None
+
+    # trinucleotide spectrum, skipping mutations at the ends of the sequence or next to ambiguous bases
+    inner = acgt & (ref != alt) & (pos >= 2) & (pos < len(sequence))
+    ref, pos, alt = ref[inner], pos[inner], alt[inner]
+    five, three = NUC_CODE[sequence[pos-2]], NUC_CODE[sequence[pos]]
+    keep = (five >= 0) & (three >= 0)
+    ref, alt, five, three = ref[keep], alt[keep], five[keep], three[keep]
+    purine = (ref == 0) | (ref == 2)
+    # for purine references count the reverse complement: swap and complement the flanking bases
+    five, three = np.where(purine, 3-three, five), np.where(purine, 3-five, three)
+    classes = SUB_INDEX[ref, alt]*16 + five*4 + three
+    return context, np.bincount(classes, minlength=len(SBS96_CLASSES))
+
+
+def spectrum_dict(counts):
+    return {label: int(count) for label, count in zip(SBS96_CLASSES, counts) if count}
+
+
+def subtree_spectra(T, spectra):
+    """
+    Sum the branch spectra over the subtree of each node in spectra. Clades are visited in
+    postorder with an explicit stack, as deep ladder-like trees exceed the recursion limit,
+    and the sums of children are dropped once their parent is done
+    """
+    totals = {}
+    clade_spectra = {}
+    stack = [(T.root, False)]
+    while stack:
+        clade, children_done = stack.pop()
+        if not children_done:
+            stack.append((clade, True))
+            stack.extend((child, False) for child in reversed(clade.clades))
+            continue
+        total = spectra.get(clade.name, np.zeros(len(SBS96_CLASSES), dtype=np.int64)).copy()
+        for child in clade.clades:
+            total += totals.pop(child)
+        totals[clade] = total
+        if clade.name in spectra:
+            clade_spectra[clade.name] = total
+    return clade_spectra
 
 
 if __name__=="__main__":
@@ -16,48 +124,24 @@ if __name__=="__main__":
     args = parser.parse_args()
 
 
+    # Nodes are streamed so that only one reconstructed sequence is held in memory at a time.
+    # Only the small per-node results are kept, as clade_sbs96 needs all branch spectra first
+    contexts = {}
+    spectra = {}
     with open(args.mutations) as fh:
-        data = json.load(fh)['nodes']
-
-
-    terminal_muts = defaultdict(lambda: defaultdict(int))
-    internal_muts = defaultdict(lambda: defaultdict(int))
-
-    node_data = {}
-
-    for name, node in data.items():
-        GA_count = 0
-        CT_count = 0
-        total_muts = 0
-        for mut in node["muts"]:
-            a, pos, d = mut[0], int(mut[1:-1]), mut[-1]
-            if a in 'ACGT' and d in 'ACGT':
-                total_muts += 1
-                if a+d == 'GA':
-                    GA_count += 1
-                elif a+d == 'CT':
-                    CT_count += 1
-        GA_CT_count = GA_count + CT_count
-        if total_muts:
-            node_data[name] = {"GA_CT_fraction": GA_CT_count/total_muts}
-        else:
-            node_data[name] = {"GA_CT_fraction": None }
-
-
-        dinuc_count = 0
-        if GA_CT_count:
-            #node_data[name]["CT_fraction"] = CT_count/GA_CT_count
-            for mut in node["muts"]:
-                a, pos, d = mut[0], int(mut[1:-1]), mut[-1]
-                if a in 'ACGT' and d in 'ACGT':
-                    if a+d == 'GA' and node['sequence'][pos]=='A':
-                        dinuc_count+=1
-                    elif a+d == 'CT' and node['sequence'][pos-2]=='T':
-                        dinuc_count+=1
-            node_data[name]["dinuc_context_fraction"] = dinuc_count/GA_CT_count
-        else:
-            node_data[name]["dinuc_context_fraction"] = None
-            #node_data[name]["CT_fraction"] = None
-
-    with open(args.output, 'w') as fh:
-        json.dump({"nodes":node_data}, fh)
+        for name, node in stream_node_data(fh):
+            contexts[name], spectra[name] = node_context(node)
+
+    clade_spectra = subtree_spectra(Phylo.read(args.tree, 'newick'), spectra)
+
+    # Nodes are written one at a time, in the same format as json.dump({"nodes": node_data})
+    with open(args.output, 'w') as out:
+        out.write('{"nodes": {')
+        for i, (name, values) in enumerate(contexts.items()):
+            values["sbs96"] = spectrum_dict(spectra[name])
+            if name in clade_spectra:
+                values["clade_sbs96"] = spectrum_dict(clade_spectra[name])
+            if i:
+                out.write(', ')
+            out.write(f'{json.dumps(name)}: {json.dumps(values)}')
+        out.write('}}')
@@ -1,6 +1,31 @@
 import pandas as pd
 import argparse
-from Bio import SeqIO
+
+# Complement of IUPAC nucleotide codes, as used by Bio.Seq.reverse_complement
+COMPLEMENT = bytes.maketrans(b"ABCDGHKMRTUVYabcdghkmrtuvy", b"TVGHCDMKYAABRtvghcdmkyaabr")
+FASTA_LINE_WIDTH = 60
+
+def read_fasta(f_in):
+    """Yield (title, sequence) byte strings of the records of a FASTA file opened in binary mode"""
+    title = None
+    lines = []
+    for line in f_in:
+        if line[:1] == b">":
+            if title is not None:
+                yield title, b"".join(lines).translate(None, b" \t\r\n")
+            title = line[1:].rstrip()
+            lines = []
+        elif title is not None:
+            lines.append(line)
+    if title is not None:
+        yield title, b"".join(lines).translate(None, b" \t\r\n")
+
+def reversed_accessions(metadata_file, column):
+    """All accessions of the metadata and the set of those flagged as reverse-complemented"""
+    metadata = pd.read_csv(metadata_file, sep='\t', usecols=['accession', column], dtype={'accession': str})
+    accessions = set(metadata['accession'])
+    reversed_accessions = set(metadata.loc[metadata[column] == True, 'accession'])
+    return accessions, reversed_accessions
 
 if __name__=="__main__":
     parser = argparse.ArgumentParser(
@@ -13,17 +38,24 @@ if __name__=="__main__":
     parser.add_argument('--output', type=str, required=True, help="output sequences")
     args = parser.parse_args()
 
-    metadata = pd.read_csv(args.metadata, sep='\t')
+    accessions, to_reverse = reversed_accessions(args.metadata, 'is_reverse_complement')
 
     # Read in fasta file
-    with open(args.sequences, 'r') as f_in:
-        with open(args.output, 'w') as f_out:
-            for seq in SeqIO.parse(f_in, 'fasta'):
-                # Check if metadata['reverse'] is True
-                if metadata.loc[metadata['accession'] == seq.id, 'is_reverse_complement'].values[0] == True:
+    with open(args.sequences, 'rb') as f_in:
+        with open(args.output, 'wb', buffering=1024 * 1024) as f_out:
+            for title, sequence in read_fasta(f_in):
+                split_title = title.decode().split(None, 1)
+                seq_id = split_title[0] if split_title else ""
+                if seq_id not in accessions:
+                    raise KeyError(f"Sequence {seq_id!r} not found in metadata {args.metadata!r}")
+
+                # Check if the metadata flags the sequence as reversed
+                if seq_id in to_reverse:
                     # Reverse-complement sequence
-                    seq.seq = seq.seq.reverse_complement()
-                    print("Reverse-complementing sequence:", seq.id)
+                    sequence = sequence.translate(COMPLEMENT)[::-1]
+                    print("Reverse-complementing sequence:", seq_id)
 
                 # Write sequences to file
-                SeqIO.write(seq, f_out, 'fasta')
+                f_out.write(b">" + title + b"\n")
+                for i in range(0, len(sequence), FASTA_LINE_WIDTH):
+                    f_out.write(sequence[i:i + FASTA_LINE_WIDTH] + b"\n")